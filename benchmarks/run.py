@@ -0,0 +1,202 @@
+"""Benchmark suite of the simplifier.
+
+Cases are taken from pinned corpora:
+  - samples: files of tests/samples
+  - examples: programs of examples/ (like xor36), simplified with the
+    custom rules of the example if it defines custom_rules
+  - generated: MBA expressions of increasing depth (number of
+    obfuscation passes) and number of bits, generated from a fixed seed
+    by sspam.tools.generator
+
+Each case is run in its own process, so that peak memory (maximum
+resident set size) is measured for the case alone. Wall time, peak
+memory and number of z3 queries of each case are printed, and can be
+stored as json (--output). Given a baseline (a json file produced by
+--output), cases whose time, memory or z3 queries exceed the baseline
+by more than the threshold are reported as regressions and the runner
+exits with status 1. Time increases smaller than MIN_TIME_DELTA seconds
+are not reported, since they are noise on short cases.
+
+Usage: python benchmarks/run.py [-k filter] [--output results.json]
+                                [--baseline baseline.json]
+                                [--threshold 0.2] [--min-delta 0.05]
+"""
+
+import argparse
+import ast
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from sspam import simplifier
+from sspam.tools.generator import MBAGenerator
+
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+SAMPLES_DIR = os.path.join(ROOT, "tests", "samples")
+EXAMPLES = ["xor36.py", "xor5c.py"]
+
+# depths (number of obfuscation passes) and number of bits of
+# generated cases
+GENERATED_DEPTHS = [1, 2, 3, 4, 5]
+GENERATED_NBITS = [8, 32, 64]
+SEED = 42
+
+# time increases (in seconds) below this are not regressions
+MIN_TIME_DELTA = 0.05
+
+
+def get_examples():
+    """
+    Return programs of examples, as dict name -> (program, custom rules
+    of the example or None)
+    """
+    programs = {}
+    for fname in EXAMPLES:
+        path = os.path.join(ROOT, "examples", fname)
+        module = ast.parse(open(path).read())
+        program, custom_rules = None, None
+        for node in module.body:
+            if not isinstance(node, ast.Assign):
+                continue
+            if isinstance(node.value, ast.Str):
+                program = node.value.s
+            elif [target.id for target in node.targets
+                  if isinstance(target, ast.Name)] == ["custom_rules"]:
+                custom_rules = ast.literal_eval(node.value)
+        programs[os.path.splitext(fname)[0]] = (program, custom_rules)
+    return programs
+
+
+def get_cases():
+    'Return list of (name, expression, nbits, custom rules) of all cases'
+    cases = []
+    for fname in sorted(os.listdir(SAMPLES_DIR)):
+        cases.append(("samples/" + fname,
+                      open(os.path.join(SAMPLES_DIR, fname)).read(), 0,
+                      None))
+    for name, (program, custom_rules) in sorted(get_examples().items()):
+        cases.append(("examples/" + name, program, 0, custom_rules))
+    for nbits in GENERATED_NBITS:
+        for depth in GENERATED_DEPTHS:
+            expr, _ = MBAGenerator(nbits, depth=depth, seed=SEED).generate()
+            cases.append(("generated/%dbits/depth%d" % (nbits, depth),
+                          expr, nbits, None))
+    return cases
+
+
+def run_case(name):
+    'Simplify case (in this process) and print its measures as json'
+    expr, nbits, custom_rules = [case[1:] for case in get_cases()
+                                 if case[0] == name][0]
+    # load sympy and z3 before measuring
+    simplifier.simplify("(x ^ y) + 2*(x & y)", 8)
+    start = time.time()
+    _, stats = simplifier.simplify_stats(expr, nbits, custom_rules)
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print json.dumps({"time": elapsed, "maxrss_kb": maxrss,
+                      "z3_queries": stats.solver["z3_queries"]})
+
+
+def measure(name, timeout):
+    'Run case in a new process, return its measures'
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT, env.get("PYTHONPATH", "")])
+    proc = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+                             "--case", name], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env)
+    start = time.time()
+    while proc.poll() is None:
+        if time.time() - start > timeout:
+            proc.kill()
+            proc.wait()
+            return {"error": "timeout"}
+        time.sleep(0.01)
+    out, err = proc.communicate()
+    if proc.returncode:
+        lines = err.strip().splitlines()
+        if lines:
+            return {"error": lines[-1]}
+        return {"error": "exit status %d" % proc.returncode}
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold, min_delta=MIN_TIME_DELTA):
+    """
+    Return list of regressions of results compared with baseline, an
+    increase of time is a regression only if larger than min_delta
+    seconds
+    """
+    regressions = []
+    for name, ref in sorted(baseline.items()):
+        res = results.get(name)
+        if res is None:
+            continue
+        if "error" in res and "error" not in ref:
+            regressions.append("%s: %s" % (name, res["error"]))
+            continue
+        for key in ("time", "maxrss_kb", "z3_queries"):
+            if key not in ref or key not in res:
+                continue
+            if key == "time" and res[key] - ref[key] <= min_delta:
+                continue
+            if res[key] > ref[key]*(1 + threshold):
+                regressions.append("%s: %s %s > %s (+%d%%)"
+                                   % (name, key, res[key], ref[key],
+                                      100*threshold))
+    return regressions
+
+
+def main(args):
+    'Run cases, print and store results, compare with baseline'
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", dest="filter", default="",
+                        help="only run cases whose name contains filter")
+    parser.add_argument("--output", help="json file to store results")
+    parser.add_argument("--baseline", help="json file of previous results")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed relative increase compared with "
+                        "baseline (default is 0.2)")
+    parser.add_argument("--min-delta", type=float, default=MIN_TIME_DELTA,
+                        help="minimum increase of time in seconds to be "
+                        "a regression (default is %s)" % MIN_TIME_DELTA)
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="maximum time of a case in seconds")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.case:
+        run_case(args.case)
+        return 0
+
+    results = {}
+    print "%-28s %9s %10s %8s" % ("case", "time", "maxrss", "z3")
+    for name, _, _, _ in get_cases():
+        if args.filter not in name:
+            continue
+        res = measure(name, args.timeout)
+        results[name] = res
+        if "error" in res:
+            print "%-28s %s" % (name, res["error"])
+        else:
+            print "%-28s %8.3fs %8dkB %8d" % (
+                name, res["time"], res["maxrss_kb"], res["z3_queries"])
+        sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        regressions = compare(results, json.load(open(args.baseline)),
+                              args.threshold, args.min_delta)
+        for regression in regressions:
+            print "regression: %s" % regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,50 @@
+"""Benchmark of solver reuse in the pattern matcher.
+
+Simplifies the samples of the test suite with a new z3 solver for each
+query, then with one solver per number of bits used with push() /
+pop(), and prints the average latency of solver queries in both
+modes. The cache of verdicts is disabled so that both runs send the
+same queries to z3.
+
+Usage: python benchmarks/solver_reuse.py [files...]
+"""
+
+import os
+import sys
+import time
+
+from sspam import pattern_matcher, simplifier
+
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           os.pardir, "tests", "samples")
+
+
+def run(fnames, incremental):
+    'Simplify all files, return wall time, number of queries and z3 time'
+    pattern_matcher.INCREMENTAL = incremental
+    pattern_matcher.SOLVERS.clear()
+    pattern_matcher.EQ_CACHE = pattern_matcher.EquivalenceCache(0)
+    pattern_matcher.STATS.clear()
+    start = time.time()
+    for fname in fnames:
+        simplifier.simplify(fname)
+    wall = time.time() - start
+    return wall, pattern_matcher.STATS["z3_queries"], \
+        pattern_matcher.STATS["z3_time"]
+
+
+def main(args):
+    'Run both modes and print results'
+    fnames = args or sorted(os.path.join(SAMPLES_DIR, fname)
+                            for fname in os.listdir(SAMPLES_DIR))
+    print "%-12s %8s %8s %10s %14s" % ("mode", "wall(s)", "queries",
+                                       "z3 time(s)", "latency(ms/q)")
+    for name, incremental in (("new solver", False), ("push/pop", True)):
+        wall, queries, z3time = run(fnames, incremental)
+        print "%-12s %8.2f %8d %10.2f %14.3f" % (name, wall, queries, z3time,
+                                                 1000*z3time/max(queries, 1))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,6 +7,11 @@ expressions for the moment). Contains:
   - custom "flexible" pattern matcher
   - pre-processing passes
   - main simplifier engine
+  - equality saturation engine (e-graph)
+  - incremental re-simplification of edited programs
+  - parallel simplification of many expressions
+  - simplification server on a Unix socket
+  - persistent store of solver verdicts
 
 - Various tools:
   - asttools for Python ast manipulation
@@ -5,21 +5,191 @@ Used to provide a sspam command for the user.
 
 import sys
 import argparse
+import json
+import os.path
 
-from sspam import simplifier
+from sspam import simplifier, pattern_matcher, parallel, server
+from sspam.verdict_store import VerdictStore
 
 
-def main(args=None):
-    'The main routine'
-    if args is None:
-        args = sys.argv[1:]
+def simplify_jsonl(lines, nbits=0, custom_rules=None, use_default=True,
+                   budget=None, scheduler=None):
+    """
+    Simplify records {id, expr, nbits} read from json lines, yield
+    records {id, result, time, stats} (or {id, error}) as soon as each
+    expression is simplified.
+    """
+    # pylint: disable=too-many-arguments
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield {"id": None, "error": str(exc)}
+            continue
+        yield parallel.simplify_record(record, nbits, custom_rules,
+                                       use_default, budget, scheduler)
+
+
+def open_input(path):
+    'Return file of path, or stdin if path is -'
+    if path == "-":
+        return sys.stdin
+    return open(path, 'r')
 
+
+def print_batch(results):
+    'Print results of simplify_many, one line per expression'
+    for number, result in enumerate(results, 1):
+        if isinstance(result, Exception):
+            # one output line per input line
+            print >> sys.stderr, "expression %d: %s" % (number, result)
+            result = ""
+        print result
+        sys.stdout.flush()
+
+
+def get_parser():
+    'Return parser of command line arguments'
     parser = argparse.ArgumentParser()
     parser.add_argument("expr", type=str, help="expression to simplify")
     parser.add_argument("-n", dest="nbits", type=int,
                         help="number of bits of the variables (default is 8)")
-    args = parser.parse_args()
-    print simplifier.simplify(args.expr, args.nbits)
+    parser.add_argument("--rules", dest="rules", type=str,
+                        help="file of rules saved by simplifier.save_rules, "
+                        "used instead of default rules")
+    parser.add_argument("--batch", dest="batch", action="store_true",
+                        help="expr is a file containing one expression per "
+                        "line (- for stdin), simplified independently")
+    parser.add_argument("--jsonl", dest="jsonl", action="store_true",
+                        help="expr is a file of json records {id, expr, "
+                        "nbits} (- for stdin), json records {id, result, "
+                        "time, stats} are printed as they are simplified")
+    parser.add_argument("--server", dest="server", action="store_true",
+                        help="expr is the path of a Unix socket on which "
+                        "json requests are answered (see sspam.server)")
+    parser.add_argument("-j", dest="workers", type=int,
+                        help="number of worker processes: independent "
+                        "assignments of expr are simplified in parallel, "
+                        "in batch mode default is the number of cpus, in "
+                        "server mode default is 1")
+    parser.add_argument("--verdict-store", dest="verdict_store", type=str,
+                        help="file where solver verdicts are kept between "
+                        "runs")
+    parser.add_argument("--verdict-store-size", dest="verdict_store_size",
+                        type=int, default=1000000,
+                        help="maximum number of verdicts kept in the store "
+                        "(default is 1000000)")
+    parser.add_argument("--z3-timeout", dest="z3_timeout", type=int,
+                        default=0,
+                        help="timeout of each solver query in milliseconds "
+                        "(default is no timeout)")
+    parser.add_argument("--z3-rlimit", dest="z3_rlimit", type=int,
+                        default=0,
+                        help="resource limit of each solver query "
+                        "(default is no limit)")
+    parser.add_argument("--z3-max-queries", dest="z3_max_queries", type=int,
+                        default=0,
+                        help="maximum number of solver queries for the "
+                        "expression (default is no limit)")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=0,
+                        help="maximum time of the simplification of an "
+                        "expression in seconds, after which the smallest "
+                        "expression found is printed (default is no "
+                        "limit)")
+    parser.add_argument("--max-steps", dest="max_steps", type=int,
+                        default=0,
+                        help="maximum number of fixpoint iterations of the "
+                        "simplification of an expression (default is no "
+                        "limit)")
+    parser.add_argument("--rule-profile", dest="rule_profile", type=str,
+                        help="file of statistics of rules used to try "
+                        "cheap rules with many matches first, and "
+                        "updated with the simplifications done (not "
+                        "supported with -j, --batch and --server)")
+    parser.add_argument("--stats", dest="stats", action="store_true",
+                        help="print time spent in each stage, fixpoint "
+                        "iterations, solver counters and statistics of "
+                        "each rule on stderr (for a single expression, "
+                        "records of --jsonl always contain statistics)")
+    return parser
+
+
+def parse_args(args=None):
+    """
+    Return parsed command line arguments (default is sys.argv), exit if
+    options are not supported together
+    """
+    parser = get_parser()
+    args = parser.parse_args(args)
+    if args.stats and (args.batch or args.jsonl or args.server or
+                       args.workers):
+        parser.error("--stats is only supported for a single expression "
+                     "without -j (use --jsonl for statistics of each "
+                     "expression)")
+    if args.rule_profile and (args.batch or args.server or args.workers):
+        parser.error("--rule-profile is not supported with -j, --batch "
+                     "and --server")
+    return args
+
+
+def load_scheduler(path):
+    'Return rule scheduler with profile of path if given, or None'
+    if not path:
+        return None
+    scheduler = simplifier.RuleScheduler()
+    if os.path.exists(path):
+        scheduler.load(path)
+    return scheduler
+
+
+def main(args=None):
+    'The main routine'
+    args = parse_args(args)
+    custom_rules, use_default = None, True
+    if args.rules:
+        custom_rules = simplifier.load_rules(args.rules)
+        use_default = False
+    pattern_matcher.BUDGET = pattern_matcher.SolverBudget(
+        args.z3_timeout, args.z3_rlimit, args.z3_max_queries)
+    budget = None
+    if args.timeout or args.max_steps:
+        budget = simplifier.SimplificationBudget(args.timeout,
+                                                 args.max_steps)
+    scheduler = load_scheduler(args.rule_profile)
+    if args.verdict_store:
+        pattern_matcher.VERDICT_STORE = VerdictStore(args.verdict_store,
+                                                     args.verdict_store_size)
+    if args.server:
+        server.serve(args.expr, args.workers or 1, custom_rules,
+                     use_default, budget)
+    elif args.jsonl:
+        for record in simplify_jsonl(open_input(args.expr), args.nbits or 0,
+                                     custom_rules, use_default, budget,
+                                     scheduler):
+            print json.dumps(record)
+            sys.stdout.flush()
+    elif args.batch:
+        exprs = (line.strip() for line in open_input(args.expr)
+                 if line.strip())
+        print_batch(parallel.simplify_many(exprs, args.nbits, args.workers,
+                                           custom_rules, use_default,
+                                           budget=budget))
+    elif args.workers:
+        print parallel.simplify_program(args.expr, args.nbits, args.workers,
+                                        custom_rules, use_default, budget)
+    else:
+        result, stats = simplifier.simplify_stats(args.expr, args.nbits,
+                                                  custom_rules, use_default,
+                                                  budget, scheduler)
+        print result
+        if stats.partial:
+            print >> sys.stderr, "partial result: out of budget"
+        if args.stats:
+            print >> sys.stderr, stats.report()
+    if scheduler is not None:
+        scheduler.save(args.rule_profile)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,11 @@
 """Arithmetic simplification module using sympy.
 
 This module simplifies symbolic expressions using only arithmetic operators.
+sympy is imported on first use, as importing it takes most of the
+startup time of sspam.
 """
 # pylint: disable=unused-import,exec-used
 import ast
-import sympy
 from copy import deepcopy
 
 from sspam.tools import asttools
@@ -12,6 +13,7 @@ from sspam.tools import asttools
 
 def run(expr_ast, nbits):
     'Apply sympy arithmetic simplifications to expression ast'
+    import sympy
 
     # variables for sympy symbols
     getid = asttools.GetIdentifiers()
@@ -0,0 +1,679 @@
+"""Equality saturation engine.
+
+Instead of greedily applying the first matching rule and starting again
+(see simplifier), this engine adds the expression and the rewrites of
+all its subterms to an e-graph: a set of equivalence classes (e-classes)
+of terms, each class containing nodes (an operator and the classes of
+its operands), hash-consed so that a node only exists once. Rewriting
+never removes a term, so applying a rule can not prevent a better
+rewriting, and the cheapest term of the class of the expression is
+extracted once the e-graph is saturated or its limits are reached.
+
+Classes included in this module are:
+ - EGraph: e-graph with union-find of classes, hash-consing of nodes,
+   constant folding, matching of rules and extraction
+ - EGraphSimplifier: simplifies a succession of assignments like
+   simplifier.Simplifier, with an e-graph for each value
+
+As in the simplifier, sums are matched whatever the order and the
+grouping of their terms: a sum in a pattern is matched on the
+flattenings of a class (the lists of terms of its sums), and the sum at
+the root of a pattern can match part of the terms, the other ones being
+added to the replacement. Besides the rules, commutativity of *, &, |,
+^, ~A == -A - 1 and simple identities are used (see BUILTIN_RULES).
+Unlike PatternMatcher, no solver is used: a wildcard only matches whole
+classes, and a constant is only matched by ~A or c*A when A can be
+computed from the constant.
+
+A term shared by several subexpressions is a single class, matched once
+per iteration, and a rule is only matched again on classes whose terms
+changed since its last search. Rules with too many matches are banned
+for a few iterations (backoff scheduling), so that the e-graph does not
+fill up with rewritings of a single rule.
+"""
+
+import ast
+
+from sspam import arithm_simpl, pattern_matcher, simplifier
+from sspam.pre_processing import all_preprocessings
+from sspam.tools import asttools
+from sspam.tools.asttools import unparse
+from sspam.tools.flattening import Flattening
+
+
+# limits of an e-graph: number of nodes and of rewriting iterations
+MAX_NODES = 2000
+MAX_ITERATIONS = 20
+
+# limits of flattenings of a class: number of terms and of flattenings
+MAX_TERMS = 8
+MAX_FLATTENINGS = 64
+
+# backoff scheduling: a rule matching more than MATCH_LIMIT times in an
+# iteration is not applied and is banned for BAN_LENGTH iterations,
+# both doubling at each ban (rules collecting terms would otherwise
+# rewrite every subset of every sum)
+MATCH_LIMIT = 100
+BAN_LENGTH = 2
+
+# rules used besides rules of the simplifier: commutativity, NOT as
+# arithmetic, neutral and absorbing elements and collection of terms
+# (done by sympy in the simplifier)
+BUILTIN_RULES = [("A * B", "B * A"),
+                 ("A & B", "B & A"),
+                 ("A | B", "B | A"),
+                 ("A ^ B", "B ^ A"),
+                 ("~A", "-A - 1"),
+                 ("-A - 1", "~A"),
+                 ("~(~A)", "A"),
+                 ("A & A", "A"),
+                 ("A | A", "A"),
+                 ("A ^ A", "0"),
+                 ("A & 0", "0"),
+                 ("A & -1", "A"),
+                 ("A | 0", "A"),
+                 ("A | -1", "-1"),
+                 ("A ^ 0", "A"),
+                 ("A + 0", "A"),
+                 ("1 * A", "A"),
+                 ("0 * A", "0"),
+                 ("A + A", "2*A"),
+                 ("A + B*A", "(B + 1)*A"),
+                 ("B*A + C*A", "(B + C)*A")]
+
+# operators whose value on constants is computed
+FOLDING = {"Add": lambda a, b: a + b,
+           "Mult": lambda a, b: a*b,
+           "BitAnd": lambda a, b: a & b,
+           "BitOr": lambda a, b: a | b,
+           "BitXor": lambda a, b: a ^ b,
+           "Invert": lambda a: ~a}
+
+
+def get_node(expr_ast, convert):
+    """
+    Return node (operator, value, children) of expr_ast, children being
+    converted with convert; value is the name of a variable or
+    function, or the value of a constant.
+    """
+    if isinstance(expr_ast, ast.Name):
+        return ("Name", expr_ast.id, ())
+    if isinstance(expr_ast, ast.Num):
+        return ("Num", expr_ast.n, ())
+    if isinstance(expr_ast, ast.BinOp):
+        return (type(expr_ast.op).__name__, None,
+                (convert(expr_ast.left), convert(expr_ast.right)))
+    if isinstance(expr_ast, ast.UnaryOp):
+        return (type(expr_ast.op).__name__, None,
+                (convert(expr_ast.operand),))
+    if (isinstance(expr_ast, ast.Call) and
+            isinstance(expr_ast.func, ast.Name) and not expr_ast.keywords
+            and expr_ast.starargs is None and expr_ast.kwargs is None):
+        return ("Call", expr_ast.func.id,
+                tuple(convert(arg) for arg in expr_ast.args))
+    raise Exception("unsupported node in e-graph: %s"
+                    % expr_ast.__class__.__name__)
+
+
+def get_ast(op, value, children):
+    'Return ast of a node whose children are given as asts'
+    if op == "Name":
+        return ast.Name(value, ast.Load())
+    if op == "Num":
+        return ast.Num(value)
+    if op == "Call":
+        return ast.Call(ast.Name(value, ast.Load()), list(children), [],
+                        None, None)
+    if len(children) == 1:
+        return ast.UnaryOp(getattr(ast, op)(), children[0])
+    return ast.BinOp(children[0], getattr(ast, op)(), children[1])
+
+
+def compile_pattern(pattern, nbits):
+    """
+    Return pattern as a tree of nodes (see get_node), wildcards being
+    nodes ("?", name, ()) and sums being flattened
+    """
+    mask = 2**nbits - 1
+
+    def convert(patt_ast):
+        'Convert a node of pattern'
+        if pattern_matcher.PatternMatcher.is_wildcard(patt_ast):
+            return ("?", patt_ast.id, ())
+        if isinstance(patt_ast, ast.Num):
+            return ("Num", patt_ast.n & mask, ())
+        if isinstance(patt_ast, ast.BoolOp):
+            # terms binding wildcards are matched first, so that terms
+            # being only a wildcard are checked rather than enumerated
+            terms = [convert(value) for value in patt_ast.values]
+            return ("Add", None, tuple(sorted(
+                terms, key=lambda term: {"Num": 0, "?": 2}.get(term[0], 1))))
+        return get_node(patt_ast, convert)
+
+    patt_ast = ast.parse(pattern, mode="eval").body
+    patt_ast = all_preprocessings(patt_ast, nbits)
+    # constants like -1 are preprocessed as 255*1 and must be folded to
+    # match constants of the e-graph
+    patt_ast = asttools.ConstFolding(patt_ast, nbits).visit(patt_ast)
+    return convert(Flattening(ast.Add).visit(patt_ast))
+
+
+class EGraph(object):
+    """
+    Classes of equivalent terms on nbits. Classes are identified by
+    integers, merged classes being represented by the root of their
+    union-find tree (see find).
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, nbits, max_nodes=MAX_NODES):
+        'Init empty e-graph'
+        self.nbits = nbits
+        self.mask = 2**nbits - 1
+        self.max_nodes = max_nodes
+        # union-find: parent of each class
+        self.parent = []
+        # root class -> set of its nodes
+        self.classes = {}
+        # canonical node -> class
+        self.hashcons = {}
+        # root class -> value, for classes equal to a constant
+        self.constants = {}
+        # number of iterations done by saturate
+        self.iterations = 0
+        # True if last saturate found nothing new to add
+        self.saturated = False
+        # class -> its flattenings, during an iteration of saturate
+        self.flat_cache = {}
+        # classes added or merged since last call of take_changed
+        self.changed = set()
+
+    def find(self, cid):
+        'Return root of class cid'
+        while self.parent[cid] != cid:
+            self.parent[cid] = self.parent[self.parent[cid]]
+            cid = self.parent[cid]
+        return cid
+
+    def canonical(self, node):
+        'Return node with root classes as children'
+        return (node[0], node[1], tuple(self.find(child)
+                                        for child in node[2]))
+
+    def size(self):
+        'Number of nodes'
+        return len(self.hashcons)
+
+    def add_node(self, node):
+        'Return class of node, adding it if needed'
+        node = self.canonical(node)
+        if node[0] == "Num":
+            node = ("Num", node[1] & self.mask, ())
+        if node in self.hashcons:
+            return self.find(self.hashcons[node])
+        cid = len(self.parent)
+        self.parent.append(cid)
+        self.classes[cid] = set([node])
+        self.hashcons[node] = cid
+        self.changed.add(cid)
+        if node[0] == "Num":
+            self.constants[cid] = node[1]
+        elif node[0] in FOLDING and node[2] and all(
+                child in self.constants for child in node[2]):
+            value = FOLDING[node[0]](*[self.constants[child]
+                                       for child in node[2]])
+            cid = self.union(cid, self.add_node(("Num", value, ())))
+        return cid
+
+    def add(self, expr_ast):
+        'Return class of expression expr_ast, adding its terms'
+        if isinstance(expr_ast, ast.Num):
+            return self.add_node(("Num", expr_ast.n, ()))
+        return self.add_node(get_node(expr_ast, self.add))
+
+    def union(self, cid1, cid2):
+        'Merge classes, return root of the merged class'
+        cid1, cid2 = self.find(cid1), self.find(cid2)
+        if cid1 == cid2:
+            return cid1
+        if len(self.classes[cid1]) < len(self.classes[cid2]):
+            cid1, cid2 = cid2, cid1
+        self.parent[cid2] = cid1
+        self.classes[cid1] |= self.classes.pop(cid2)
+        if cid2 in self.constants:
+            self.constants[cid1] = self.constants.pop(cid2)
+        self.changed.add(cid1)
+        return cid1
+
+    def rebuild(self):
+        """
+        Restore invariants after unions: nodes are canonical, and
+        classes containing the same node are merged (congruence)
+        """
+        changed = True
+        while changed:
+            changed = False
+            self.hashcons = {}
+            for cid in list(self.classes):
+                if cid not in self.classes:
+                    # merged during this pass
+                    continue
+                nodes = set(self.canonical(node)
+                            for node in self.classes[cid])
+                self.classes[cid] = nodes
+                for node in list(nodes):
+                    other = self.hashcons.get(node)
+                    if other is not None and self.find(other) != cid:
+                        cid = self.union(cid, other)
+                        changed = True
+                    self.hashcons[node] = cid
+
+    def take_changed(self):
+        """
+        Return classes changed since last call and their ancestors (the
+        classes whose terms contain them), which are the only ones where
+        new matches can be found
+        """
+        parents = {}
+        for cid, nodes in self.classes.items():
+            for node in nodes:
+                for child in node[2]:
+                    parents.setdefault(self.find(child), set()).add(cid)
+        todo = set(self.find(cid) for cid in self.changed)
+        self.changed = set()
+        result = set()
+        while todo:
+            cid = todo.pop()
+            result.add(cid)
+            todo |= parents.get(cid, set()) - result
+        return result
+
+    def flattenings(self, cid):
+        """
+        Return flattenings of class cid: sorted tuples of the classes of
+        the terms of its sums, cid itself being a flattening of one term
+        """
+        return self.get_flattenings(self.find(cid), frozenset())[0]
+
+    def get_flattenings(self, cid, stack):
+        """
+        Return (flattenings of root class cid, True if they are
+        complete), sums of classes of stack being skipped
+        """
+        if cid in self.flat_cache:
+            return self.flat_cache[cid], True
+        if cid in self.constants:
+            return [(cid,)], True
+        result = set([(cid,)])
+        complete = True
+        # sums containing themselves (like x + 0) are not flattened
+        stack = stack | set([cid])
+        for node in self.classes[cid]:
+            if node[0] != "Add":
+                continue
+            if any(self.find(child) in stack for child in node[2]):
+                complete = False
+                continue
+            lefts, left_complete = self.get_flattenings(
+                self.find(node[2][0]), stack)
+            rights, right_complete = self.get_flattenings(
+                self.find(node[2][1]), stack)
+            complete = complete and left_complete and right_complete
+            for left in lefts:
+                for right in rights:
+                    if (len(left) + len(right) <= MAX_TERMS and
+                            len(result) < MAX_FLATTENINGS):
+                        result.add(tuple(sorted(left + right)))
+        result = sorted(result)
+        # flattenings missing sums skipped because of the stack are
+        # only valid for this stack
+        if complete or len(stack) == 1:
+            self.flat_cache[cid] = result
+        return result, complete
+
+    def match(self, pattern, cid, subst):
+        'Yield substitutions extending subst so that pattern matches cid'
+        cid = self.find(cid)
+        op, value, children = pattern
+        if op == "?":
+            if value not in subst:
+                extended = dict(subst)
+                extended[value] = cid
+                yield extended
+            elif self.find(subst[value]) == cid:
+                yield subst
+            return
+        if op == "Num":
+            if self.constants.get(cid) == value:
+                yield subst
+            return
+        if op == "Add":
+            matches = self.match_sum(children, cid, subst)
+        else:
+            matches = self.match_node(pattern, cid, subst)
+        for extended in matches:
+            yield extended
+
+    def match_sum(self, patterns, cid, subst):
+        'Yield substitutions so that the sum of patterns matches cid'
+        for terms in self.flattenings(cid):
+            if len(terms) != len(patterns):
+                continue
+            for extended, _ in self.match_terms(patterns, terms, subst):
+                yield extended
+
+    def match_node(self, pattern, cid, subst):
+        """
+        Yield substitutions so that pattern (an operator that is not a
+        sum) matches a node of cid, or the constant of cid
+        """
+        op, value, children = pattern
+        if cid in self.constants:
+            solved = self.solve(pattern, self.constants[cid], subst)
+            if solved is not None:
+                yield solved
+        for node in list(self.classes[cid]):
+            if (node[0] != op or node[1] != value or
+                    len(node[2]) != len(children)):
+                continue
+            for extended in self.match_all(children, node[2], subst):
+                yield extended
+
+    def match_all(self, patterns, cids, subst):
+        'Yield substitutions so that each pattern matches its class'
+        if not patterns:
+            yield subst
+            return
+        for extended in self.match(patterns[0], cids[0], subst):
+            for result in self.match_all(patterns[1:], cids[1:], extended):
+                yield result
+
+    def match_terms(self, patterns, terms, subst):
+        """
+        Yield (substitution, terms left) so that each pattern matches a
+        distinct term, in any order
+        """
+        if not patterns:
+            yield subst, terms
+            return
+        for j, term in enumerate(terms):
+            if term in terms[:j]:
+                # same class was already tried
+                continue
+            rest = terms[:j] + terms[j + 1:]
+            for extended in self.match(patterns[0], term, subst):
+                for result in self.match_terms(patterns[1:], rest, extended):
+                    yield result
+
+    def match_root(self, pattern, cid):
+        """
+        Yield (substitution, terms left) so that pattern matches cid,
+        a sum pattern matching part of the terms of a sum
+        """
+        if pattern[0] != "Add":
+            for subst in self.match(pattern, cid, {}):
+                yield subst, ()
+            return
+        for terms in self.flattenings(cid):
+            if len(terms) >= len(pattern[2]):
+                for result in self.match_terms(pattern[2], terms, {}):
+                    yield result
+
+    def solve(self, pattern, constant, subst):
+        """
+        Return subst extended so that ~A or c*A pattern is equal to
+        constant, or None if A can't be computed
+        """
+        op, _, children = pattern
+        if op == "Invert" and children[0][0] == "?":
+            wildcard, value = children[0][1], ~constant & self.mask
+        elif (op == "Mult" and
+              [child[0] for child in children] == ["Num", "?"]):
+            coeff = children[0][1]
+            wildcard = children[1][1]
+            if not coeff:
+                return None
+            # coeff = 2**shift*odd: solution only if constant is a
+            # multiple of 2**shift
+            shift = 0
+            while not coeff & (1 << shift):
+                shift += 1
+            if constant & ((1 << shift) - 1):
+                return None
+            odd = coeff >> shift
+            inverse = pow(odd, 2**(self.nbits - 1) - 1, 2**self.nbits)
+            value = ((constant >> shift)*inverse) & self.mask
+        else:
+            return None
+        if wildcard in subst:
+            if self.constants.get(self.find(subst[wildcard])) != value:
+                return None
+            return subst
+        extended = dict(subst)
+        extended[wildcard] = self.add_node(("Num", value, ()))
+        return extended
+
+    def instantiate(self, pattern, subst, terms=()):
+        """
+        Add pattern with values of wildcards in subst, plus terms if
+        given, return its class
+        """
+        op, value, children = pattern
+        if op == "?":
+            cid = subst[value]
+        elif op == "Add":
+            cid = self.instantiate(children[0], subst)
+            terms = tuple(self.instantiate(child, subst)
+                          for child in children[1:]) + tuple(terms)
+        else:
+            cid = self.add_node((op, value, tuple(
+                self.instantiate(child, subst) for child in children)))
+        for term in terms:
+            cid = self.add_node(("Add", None, (cid, term)))
+        return cid
+
+    def search(self, rule, pattern, cids, applied, limit):
+        """
+        Return new matches (rule, class, substitution, terms left) of
+        pattern on classes cids, stopping after limit + 1 matches
+        """
+        # pylint: disable=too-many-arguments
+        matches = []
+        # nothing is smaller than a constant, so classes of constants
+        # are not rewritten
+        for cid in sorted(cids - set(self.constants)):
+            for subst, terms in self.match_root(pattern, cid):
+                key = (rule, self.find(cid),
+                       tuple(sorted((name, self.find(value))
+                                    for name, value in subst.items())),
+                       tuple(sorted(self.find(term) for term in terms)))
+                if key in applied:
+                    continue
+                matches.append((key, (rule, cid, subst, terms)))
+                if len(matches) > limit:
+                    return matches
+        return matches
+
+    def classes_by_op(self):
+        'Return dict operator -> classes with a node of this operator'
+        by_op = {}
+        for cid, nodes in self.classes.items():
+            for node in nodes:
+                by_op.setdefault(node[0], set()).add(cid)
+        return by_op
+
+    def search_rules(self, rules, applied, bans, dirty, budget):
+        """
+        Return new matches of rules on classes changed since their last
+        search (dirty classes), banning rules with too many matches
+        """
+        # pylint: disable=too-many-arguments
+        self.flat_cache = {}
+        changed = self.take_changed()
+        by_op = self.classes_by_op()
+        matches = []
+        for i, (pattern, _) in enumerate(rules):
+            if budget is not None and budget.exhausted():
+                break
+            dirty[i] = set(self.find(cid) for cid in dirty[i] | changed)
+            last, times = bans.get(i, (0, 0))
+            if last >= self.iterations:
+                continue
+            if pattern[0] == "?":
+                cids = set(dirty[i])
+            else:
+                cids = dirty[i] & by_op.get(pattern[0], set())
+            limit = MATCH_LIMIT << times
+            found = self.search(i, pattern, cids, applied, limit)
+            if len(found) > limit:
+                bans[i] = (self.iterations + (BAN_LENGTH << times),
+                           times + 1)
+                continue
+            dirty[i] = set()
+            for key, match in found:
+                applied.add(key)
+                matches.append(match)
+        return matches
+
+    def apply_matches(self, rules, matches):
+        'Add replacements of matches to their classes, then rebuild'
+        for i, cid, subst, terms in matches:
+            if self.size() >= self.max_nodes:
+                break
+            self.union(cid, self.instantiate(rules[i][1], subst, terms))
+        self.rebuild()
+
+    def saturate(self, rules, max_iterations=MAX_ITERATIONS, budget=None):
+        """
+        Apply rules (list of compiled (pattern, replacement)) until
+        nothing new is found or limits are reached; an iteration is a
+        step of budget (see simplifier.SimplificationBudget), matches
+        found before budget runs out are applied
+        """
+        applied = set()
+        # rule -> (last iteration it is banned, number of bans)
+        bans = {}
+        # rule -> classes to search again
+        dirty = dict((i, set()) for i in range(len(rules)))
+        self.saturated = False
+        for self.iterations in range(1, max_iterations + 1):
+            if budget is not None and budget.exhausted():
+                return
+            matches = self.search_rules(rules, applied, bans, dirty, budget)
+            if not matches:
+                if all(last < self.iterations + 1
+                       for last, _ in bans.values()):
+                    self.saturated = True
+                    return
+                continue
+            self.apply_matches(rules, matches)
+            if budget is not None:
+                budget.steps += 1
+            if self.size() >= self.max_nodes:
+                return
+
+    def extract(self, cid):
+        'Return ast of the smallest term of class cid (after rebuild)'
+        cid = self.find(cid)
+        # root class -> (size, node) of smallest known term
+        best = {}
+        changed = True
+        while changed:
+            changed = False
+            for root, nodes in self.classes.items():
+                for node in nodes:
+                    if not all(child in best for child in node[2]):
+                        continue
+                    cost = (1 + sum(best[child][0] for child in node[2]),
+                            node)
+                    if root not in best or cost < best[root]:
+                        best[root] = cost
+                        changed = True
+
+        def build(root):
+            'Build ast of smallest term of root'
+            op, value, children = best[root][1]
+            children = [build(child) for child in children]
+            # x + (-c) and (-1)*x are written x - c and -x
+            if (op == "Add" and isinstance(children[1], ast.Num) and
+                    children[1].n > self.mask >> 1):
+                return ast.BinOp(children[0], ast.Sub(),
+                                 ast.Num(self.mask + 1 - children[1].n))
+            if (op == "Mult" and isinstance(children[0], ast.Num) and
+                    children[0].n == self.mask):
+                return ast.UnaryOp(ast.USub(), children[1])
+            return get_ast(op, value, children)
+        return build(cid)
+
+
+class EGraphSimplifier(ast.NodeTransformer):
+    """
+    Simplifies a succession of assignments, like simplifier.Simplifier,
+    with equality saturation of each value.
+    """
+
+    def __init__(self, nbits, rules_list=simplifier.DEFAULT_RULES,
+                 max_nodes=MAX_NODES, max_iterations=MAX_ITERATIONS,
+                 budget=None):
+        'Init context and compile rules'
+        # pylint: disable=dangerous-default-value,too-many-arguments
+        self.context = {}
+        self.nbits = nbits
+        self.max_nodes = max_nodes
+        self.max_iterations = max_iterations
+        self.budget = budget
+        self.rules = [(compile_pattern(pattern, nbits),
+                       compile_pattern(replacement, nbits))
+                      for pattern, replacement
+                      in BUILTIN_RULES + list(rules_list)]
+
+    def simplify(self, expr_ast):
+        'Return smallest expression equivalent to expr_ast found'
+        egraph = EGraph(self.nbits, self.max_nodes)
+        expr_ast = arithm_simpl.run(expr_ast, self.nbits)
+        expr_ast = all_preprocessings(expr_ast, self.nbits)
+        cid = egraph.add(expr_ast)
+        egraph.saturate(self.rules, self.max_iterations, self.budget)
+        result = egraph.extract(cid)
+        # same cleaning as the output of simplifier, if it helps
+        cleaned = arithm_simpl.run(asttools.ConstFolding(
+            result, self.nbits).visit(result), self.nbits)
+        cleaned = asttools.GetConstMod(self.nbits).visit(cleaned)
+        if simplifier.expr_size(cleaned) <= simplifier.expr_size(result):
+            return cleaned
+        return result
+
+    def visit_Assign(self, node):
+        'Simplify value of assignment and update context'
+        node.value = pattern_matcher.EvalPattern(
+            self.context).visit(node.value)
+        node.value = self.simplify(node.value)
+        for target in node.targets:
+            self.context[target.id] = node.value
+        return node
+
+    def visit_Expr(self, node):
+        'Simplify expression and replace it'
+        node.value = self.simplify(node.value)
+        return node
+
+
+def simplify(expr, nbits=0, custom_rules=None, use_default=True,
+             max_nodes=MAX_NODES, max_iterations=MAX_ITERATIONS,
+             budget=None):
+    """
+    Same as simplifier.simplify, with equality saturation: expression
+    (or file) expr is simplified with rules (default rules and/or
+    custom rules) in an e-graph of at most max_nodes nodes and
+    max_iterations rewriting iterations, and within budget if given.
+    """
+    # pylint: disable=too-many-arguments
+    expr_ast = simplifier.parse_input(expr)
+    if not nbits:
+        nbits = asttools.get_default_nbits(expr_ast)
+    rules_list = simplifier.get_rules_list(custom_rules, use_default)
+    if budget is not None:
+        budget.reset()
+    expr_ast = EGraphSimplifier(nbits, rules_list, max_nodes,
+                                max_iterations, budget).visit(expr_ast)
+    return unparse(expr_ast).strip('\n')
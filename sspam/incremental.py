@@ -0,0 +1,74 @@
+"""Incremental simplification of a succession of assignments.
+
+IncrementalSimplifier simplifies programs like simplifier.simplify
+does, but remembers the result of each statement of the last program
+with the inputs it was computed from: its source and the simplified
+values of the earlier assignments it reads (its dependencies).
+
+When the same program is simplified again after an edit, statements
+whose source and dependencies did not change reuse their previous
+result, so only the edited statements and the ones downstream of
+them whose inputs actually changed are simplified again.
+"""
+
+import ast
+from copy import deepcopy
+
+from sspam import pattern_matcher, simplifier
+from sspam.tools import asttools
+from sspam.tools.asttools import unparse
+
+
+class IncrementalSimplifier(object):
+    """
+    Simplify programs, re-using results of unchanged statements of the
+    previously simplified program.
+    """
+
+    def __init__(self, nbits=0, rules_list=None):
+        'Init cache of results'
+        self.nbits = nbits
+        self.rules_list = rules_list
+        # key of statement -> simplified value
+        self.results = {}
+        # statements simplified / re-used during last run
+        self.simplified = 0
+        self.reused = 0
+
+    def simplify(self, expr):
+        'Simplify expression (or file), as simplifier.simplify does'
+        expr_ast = simplifier.parse_input(expr)
+        nbits = self.nbits
+        if not nbits:
+            nbits = asttools.get_default_nbits(expr_ast)
+        rules_list = self.rules_list
+        if rules_list is None:
+            rules_list = simplifier.DEFAULT_RULES
+        pattern_matcher.BUDGET.reset()
+        simp = simplifier.Simplifier(nbits, rules_list)
+        results = {}
+        self.simplified = 0
+        self.reused = 0
+        for i, node in enumerate(expr_ast.body):
+            if not isinstance(node, (ast.Assign, ast.Expr)):
+                expr_ast.body[i] = simp.visit(node)
+                continue
+            getid = asttools.GetIdentifiers()
+            getid.visit(node.value)
+            deps = sorted(var for var in getid.variables
+                          if var in simp.context)
+            key = (nbits, ast.dump(node),
+                   tuple((var, ast.dump(simp.context[var])) for var in deps))
+            if key in self.results:
+                node.value = deepcopy(self.results[key])
+                if isinstance(node, ast.Assign):
+                    for target in node.targets:
+                        simp.context[target.id] = node.value
+                self.reused += 1
+            else:
+                simp.visit(node)
+                self.simplified += 1
+            results[key] = deepcopy(node.value)
+        # only results of the last program are kept
+        self.results = results
+        return unparse(expr_ast).strip('\n')
@@ -0,0 +1,236 @@
+"""Parallel simplification.
+
+simplify_many() spreads independent expressions over a pool of worker
+processes and yields simplified expressions in input order, as soon as
+they (and all previous ones) are available. Expressions are read from
+the input as workers need them: at most MAX_PENDING chunks per worker
+are sent and not yet yielded, so that memory does not grow with the
+size of the input (or when the consumer of results is slow).
+
+simplify_program() simplifies the assignments of one program (like the
+output of cse) in parallel: an assignment is sent to a worker, with
+the simplified values of the variables it reads, as soon as the
+assignments defining these variables are simplified.
+
+Rules are compiled at most once per worker and number of bits (see
+simplifier.compile_rules), and workers inherit configuration of the
+parent process (solver budget, verdict store...) when forked.
+
+A simplifier.SimplificationBudget given to simplify_many applies to
+each expression. Given to simplify_program, its time limit applies to
+the whole program, but fixpoint iterations are counted by each worker.
+Likewise, each worker orders rules with its own copy of a
+simplifier.RuleScheduler, the one of the parent process is not updated.
+"""
+
+import ast
+from collections import deque
+import itertools
+import multiprocessing
+import Queue
+import time
+
+from sspam import simplifier, pattern_matcher
+from sspam.tools import asttools
+from sspam.tools.asttools import unparse
+
+
+# maximum number of chunks of simplify_many sent to each worker and not
+# yet yielded
+MAX_PENDING = 4
+
+
+def simplify_one(args):
+    """
+    Simplify one expression in a worker, args are those of simplify(),
+    return simplified expression or exception raised
+    """
+    expr, nbits, custom_rules, use_default, budget, scheduler = args
+    try:
+        return simplifier.simplify(expr, nbits, custom_rules, use_default,
+                                   budget, scheduler)
+    except Exception as exc:  # pylint: disable=broad-except
+        # exceptions of sympy or z3 may not be picklable
+        return Exception("%s: %s" % (type(exc).__name__, exc))
+
+
+def simplify_chunk(tasks):
+    'Simplify a list of expressions in a worker (see simplify_one)'
+    return [simplify_one(task) for task in tasks]
+
+
+def simplify_record(record, nbits=0, custom_rules=None, use_default=True,
+                    budget=None, scheduler=None):
+    """
+    Simplify expression of record {id, expr, nbits} (see
+    simplifier.simplify), return record {id, result, time, stats} with
+    statistics of the simplification (see
+    simplifier.SimplificationStats), or {id, error} if it could not be
+    simplified. Records of results cut by budget also have partial set
+    to true.
+    """
+    # pylint: disable=too-many-arguments
+    ident = record.get("id") if isinstance(record, dict) else None
+    try:
+        start = time.time()
+        result, stats = simplifier.simplify_stats(record["expr"],
+                                                  record.get("nbits", nbits),
+                                                  custom_rules, use_default,
+                                                  budget, scheduler)
+        response = {"id": ident, "result": result,
+                    "time": time.time() - start, "stats": stats.as_dict()}
+        if stats.partial:
+            response["partial"] = True
+        return response
+    except Exception as exc:  # pylint: disable=broad-except
+        return {"id": ident, "error": str(exc)}
+
+
+def simplify_many(exprs, nbits=0, workers=None, custom_rules=None,
+                  use_default=True, chunksize=1, budget=None,
+                  scheduler=None):
+    """
+    Simplify each expression of exprs (see simplifier.simplify) with
+    workers processes (default is the number of cpus), yield results
+    in input order; the result of an expression that can't be
+    simplified is the exception raised, so that other expressions are
+    still simplified.
+    """
+    # pylint: disable=too-many-arguments
+    tasks = ((expr, nbits, custom_rules, use_default, budget, scheduler)
+             for expr in exprs)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for task in tasks:
+            yield simplify_one(task)
+        return
+    pool = multiprocessing.Pool(workers)
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < workers*MAX_PENDING:
+                chunk = list(itertools.islice(tasks, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(simplify_chunk, [chunk]))
+            if not pending:
+                break
+            for result in pending.popleft().get():
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def simplify_statement(args):
+    """
+    Simplify one statement in a worker, with values of the variables
+    it reads, return simplified statement (or exception raised)
+    """
+    node, context, nbits, rules_list, budget, scheduler = args
+    try:
+        pattern_matcher.BUDGET.reset()
+        simp = simplifier.Simplifier(nbits, rules_list, budget=budget,
+                                     scheduler=scheduler)
+        simp.context = context
+        return simp.visit(node)
+    except Exception as exc:  # pylint: disable=broad-except
+        return exc
+
+
+def get_dependencies(body):
+    """
+    Return, for each statement of body, a dict giving for each variable
+    it reads the index of the assignment defining it, or None if
+    statements can't be simplified independently.
+    """
+    defined = {}
+    dependencies = []
+    for i, node in enumerate(body):
+        if isinstance(node, ast.Expr):
+            # expressions do not use values of variables
+            dependencies.append({})
+            continue
+        if not isinstance(node, ast.Assign):
+            return None
+        if not all(isinstance(target, ast.Name) for target in node.targets):
+            return None
+        getid = asttools.GetIdentifiers()
+        getid.visit(node.value)
+        dependencies.append(dict((var, defined[var])
+                                 for var in getid.variables
+                                 if var in defined))
+        for target in node.targets:
+            defined[target.id] = i
+    return dependencies
+
+
+def simplify_statements(body, dependencies, workers, args):
+    """
+    Simplify statements of body with workers processes, sending a
+    statement as soon as the ones it depends on are simplified; args
+    are (nbits, rules_list, budget, scheduler) of simplify_statement.
+    """
+    # number of statements each statement is waiting for, and
+    # statements waiting for each statement
+    waiting = [len(set(deps.values())) for deps in dependencies]
+    dependents = [set() for _ in body]
+    for i, deps in enumerate(dependencies):
+        for j in deps.values():
+            dependents[j].add(i)
+
+    done = Queue.Queue()
+    pool = multiprocessing.Pool(workers)
+
+    def submit(i):
+        'Send i-th statement to a worker'
+        context = dict((var, body[j].value)
+                       for var, j in dependencies[i].items())
+        pool.apply_async(simplify_statement,
+                         [(body[i], context) + args],
+                         callback=lambda result: done.put((i, result)))
+
+    try:
+        for i in range(len(body)):
+            if not waiting[i]:
+                submit(i)
+        for _ in range(len(body)):
+            i, result = done.get()
+            if isinstance(result, Exception):
+                raise result
+            body[i] = result
+            for j in dependents[i]:
+                waiting[j] -= 1
+                if not waiting[j]:
+                    submit(j)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def simplify_program(expr, nbits=0, workers=None, custom_rules=None,
+                     use_default=True, budget=None, scheduler=None):
+    """
+    Simplify program expr (see simplifier.simplify) with workers
+    processes (default is the number of cpus), simplifying independent
+    assignments concurrently.
+    """
+    # pylint: disable=too-many-arguments
+    expr_ast = simplifier.parse_input(expr)
+    dependencies = get_dependencies(expr_ast.body)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or dependencies is None:
+        return simplifier.simplify(expr, nbits, custom_rules, use_default,
+                                   budget, scheduler)
+    if not nbits:
+        nbits = asttools.get_default_nbits(expr_ast)
+    rules_list = simplifier.get_rules_list(custom_rules, use_default)
+    if budget is not None:
+        budget.reset()
+    simplify_statements(expr_ast.body, dependencies, workers,
+                        (nbits, rules_list, budget, scheduler))
+    return unparse(expr_ast).strip('\n')
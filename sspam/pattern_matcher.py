@@ -6,28 +6,34 @@ eventually replace it with another expression if found.
 Classes and methods included in this module are:
  - EvalPattern: replaces wildcards in a pattern with their supposed
    values.
+ - Bindings: values of wildcards, with a trail of modifications used
+   for backtracking.
+ - EquivalenceCache: bounded LRU cache of z3 equivalence verdicts.
+   Verdicts can also be kept between runs in VERDICT_STORE (see
+   verdict_store module).
+ - CompiledPattern: pattern with pre-computed matching routines.
  - PatternMatcher: returns true if pattern is matched on expression.
  - match: same as PatternMatcher, but with pre-processing applied
    first
+ - get_head / get_pattern_head: operator at the root of a node, used
+   to skip nodes a pattern can not match
  - PatternReplacement: takes pattern, replacement expression and target
    expression as input ; if pattern is found in target expression,
-   replaces it with replacement expression
+   replaces it with replacement expression. Subterms where the pattern
+   was not found can be remembered, to skip them in later visits.
  - replace: same as PatternReplacement, but with pre-processing
    applied first.
 """
 
 
 import ast
+from collections import Counter, OrderedDict
 from copy import deepcopy
 import itertools
-import astunparse
+import time
 
-try:
-    import z3
-except ImportError:
-    raise Exception("z3 module is needed to use this pattern matcher")
-
-from sspam.tools import asttools
+from sspam.tools import asttools, evaluator
+from sspam.tools.z3_translator import Z3Translator, load_z3
 from sspam.tools.flattening import Flattening, Unflattening
 from sspam import pre_processing
 
@@ -35,22 +41,241 @@ from sspam import pre_processing
 # If set to true, pattern matcher will use z3 to match patterns
 FLEXIBLE = True
 
+# If set to true, candidates are evaluated on REFUTATION_SAMPLES random
+# inputs before being sent to z3
+REFUTATION = True
+REFUTATION_SAMPLES = 32
+
+# If set to true, queries are sent to one solver per number of bits,
+# inside push() / pop(), instead of a new solver for each query
+INCREMENTAL = True
+SOLVERS = {}
+
+# counters of solver usage: queries sent to z3 (and time spent in
+# z3), queries avoided because random evaluation proved the candidate
+# wrong, queries z3 could not answer within their budget and queries
+# skipped because the budget of the simplification was exhausted
+STATS = Counter()
+
+
+class SolverBudget(object):
+    """
+    Resource limits of the solver: timeout (in milliseconds) and
+    rlimit of each query, and maximum number of queries for one
+    simplification (see reset). Zero means no limit.
+
+    Queries out of budget are considered as "unknown", thus as not
+    matching.
+    """
+
+    def __init__(self, timeout=0, rlimit=0, max_queries=0):
+        'Init limits and number of queries done'
+        self.timeout = timeout
+        self.rlimit = rlimit
+        self.max_queries = max_queries
+        self.queries = 0
+
+    def reset(self):
+        'Start a new simplification'
+        self.queries = 0
+
+    def exhausted(self):
+        'Return True if no more queries should be sent to the solver'
+        return bool(self.max_queries) and self.queries >= self.max_queries
+
+    def configure(self, solver):
+        'Set limits of a query on solver'
+        # 2**32 - 1 is the default (no timeout) of z3
+        solver.set("timeout", self.timeout or 2**32 - 1)
+        solver.set("rlimit", self.rlimit)
+
+
+BUDGET = SolverBudget()
+
+
+def get_solver(nbits):
+    'Return solver to use for queries on nbits'
+    z3 = load_z3()
+    if not INCREMENTAL:
+        return z3.Solver()
+    if nbits not in SOLVERS:
+        SOLVERS[nbits] = z3.Solver()
+    return SOLVERS[nbits]
+
+
+class EquivalenceCache(object):
+    """
+    Bounded LRU cache of the verdicts of check_eq_z3, indexed by the
+    canonical keys of both operands and the number of bits.
+    """
+
+    def __init__(self, maxsize=10000):
+        'Init storage and counters, a maxsize of 0 disables the cache'
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        'Return cached verdict for key, or None if it is unknown'
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # move entry to the most recently used end
+        verdict = self.entries.pop(key)
+        self.entries[key] = verdict
+        return verdict
+
+    def set(self, key, verdict):
+        'Store verdict, evicting least recently used entries if full'
+        if not self.maxsize:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = verdict
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        'Remove all entries and reset counters'
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        'Return counters of the cache'
+        return {"size": len(self.entries), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+# cache shared by all pattern matchers (they are instantiated for each
+# node of the target, so a per-instance cache would be useless)
+EQ_CACHE = EquivalenceCache()
+
+# optional persistent store of solver verdicts (see verdict_store),
+# shared between runs
+VERDICT_STORE = None
+
 
 class EvalPattern(ast.NodeTransformer):
     """
     Replace wildcards in pattern with supposed values.
     """
 
-    def __init__(self, wildcards):
+    def __init__(self, wildcards, copy=True):
+        'If copy is False, values are shared with the result'
         self.wildcards = wildcards
+        self.copy = copy
 
     def visit_Name(self, node):
         'Replace wildcards with supposed value'
         if node.id in self.wildcards:
+            if not self.copy:
+                return self.wildcards[node.id]
             return deepcopy(self.wildcards[node.id])
         return node
 
 
+# marker of unbound wildcards in trail of Bindings
+UNBOUND = object()
+
+
+class Bindings(dict):
+    """
+    Values of wildcards, with a trail of modifications: backtracking to
+    a previous state only costs the number of bindings changed since,
+    and values (ast) are never copied.
+    """
+
+    def __init__(self, *args, **kwargs):
+        'Trail contains (wildcard, old value, new value) for each binding'
+        super(Bindings, self).__init__(*args, **kwargs)
+        self.trail = []
+
+    def __setitem__(self, key, value):
+        'Record binding in trail'
+        self.trail.append((key, self.get(key, UNBOUND), value))
+        dict.__setitem__(self, key, value)
+
+    def mark(self):
+        'Return position in trail, to be given to undo'
+        return len(self.trail)
+
+    def undo(self, mark):
+        'Go back to state of bindings at position mark'
+        while len(self.trail) > mark:
+            key, old_value, _ = self.trail.pop()
+            if old_value is UNBOUND:
+                dict.__delitem__(self, key)
+            else:
+                dict.__setitem__(self, key, old_value)
+
+    def changes(self, mark):
+        'Return bindings done since position mark, to be given to redo'
+        return [(key, value) for key, _, value in self.trail[mark:]]
+
+    def redo(self, changes):
+        'Replay bindings previously returned by changes'
+        for key, value in changes:
+            self[key] = value
+
+    def key(self):
+        'Hashable key of bindings, invariant by commutativity of values'
+        return frozenset((wil, asttools.get_canonical_key(value))
+                         for wil, value in self.iteritems())
+
+
+class CompiledPattern(object):
+    """
+    Pattern compiled once into a specialized matching routine for each
+    of its nodes: checks done by PatternMatcher.visit that only depend
+    on the pattern (is it a wildcard, which visit_ method to use) are
+    resolved at compilation.
+
+    The pattern must not be modified after compilation.
+    """
+
+    def __init__(self, patt_ast):
+        'Compile every node of pattern'
+        if isinstance(patt_ast, ast.Module):
+            patt_ast = patt_ast.body[0].value
+        elif isinstance(patt_ast, ast.Expression):
+            patt_ast = patt_ast.body
+        self.patt_ast = patt_ast
+        self.head = get_pattern_head(patt_ast)
+        # id(node) -> routine(matcher, target, node)
+        self.routines = {}
+        for node in ast.walk(patt_ast):
+            if isinstance(node, ast.expr):
+                routine = self.compile_node(node)
+                if routine is not None:
+                    self.routines[id(node)] = routine
+
+    @staticmethod
+    def compile_node(node):
+        'Return matching routine of a pattern node'
+        if PatternMatcher.is_wildcard(node):
+            return PatternMatcher.check_wildcard
+        nodetype = type(node)
+        compare = getattr(PatternMatcher, "visit_%s" % nodetype.__name__,
+                          None)
+        if not compare:
+            # let PatternMatcher.visit raise the usual exception
+            return None
+
+        def routine(matcher, target, pattern):
+            'Compare target with pattern node of type nodetype'
+            if type(target) is not nodetype:
+                if FLEXIBLE:
+                    return matcher.check_pattern(target, pattern)
+                return False
+            return compare(matcher, target, pattern)
+        return routine
+
+
 class PatternMatcher(asttools.Comparator):
     """
     Try to match desired pattern with given ast.
@@ -58,15 +283,19 @@ class PatternMatcher(asttools.Comparator):
     Example : A + B will match (x | 34) + (y*67)
     """
 
-    def __init__(self, root, nbits=0):
-        'Init different components of pattern matcher'
+    def __init__(self, root, nbits=0, compiled=None):
+        """
+        Init different components of pattern matcher ; compiled is an
+        optional CompiledPattern of the pattern that will be visited
+        """
 
         super(PatternMatcher, self).__init__()
+        self.routines = compiled.routines if compiled else None
 
         # wildcards used in the pattern with their possible values
-        self.wildcards = {}
-        # wildcards <-> values that are known not to work
-        self.no_solution = []
+        self.wildcards = Bindings()
+        # keys of wildcards <-> values that are known not to work
+        self.no_solution = set()
 
         # root node of expression
         if isinstance(root, ast.Module):
@@ -80,11 +309,25 @@ class PatternMatcher(asttools.Comparator):
         else:
             self.nbits = nbits
 
-        # identifiers for z3 evaluation
-        getid = asttools.GetIdentifiers()
-        getid.visit(self.root)
-        self.variables = getid.variables
-        self.functions = getid.functions
+        self.translator = Z3Translator(self.nbits)
+        self.identifiers = None
+
+    def get_identifiers(self):
+        'Identifiers of root, only computed if needed'
+        if self.identifiers is None:
+            self.identifiers = asttools.GetIdentifiers()
+            self.identifiers.visit(self.root)
+        return self.identifiers
+
+    @property
+    def variables(self):
+        'Variables of root'
+        return self.get_identifiers().variables
+
+    @property
+    def functions(self):
+        'Functions of root'
+        return self.get_identifiers().functions
 
     @staticmethod
     def is_wildcard(node):
@@ -92,8 +335,33 @@ class PatternMatcher(asttools.Comparator):
         return isinstance(node, ast.Name) and node.id.isupper()
 
     def check_eq_z3(self, target, pattern):
-        'Check equivalence with z3'
-        # pylint: disable=exec-used
+        'Check equivalence with z3, using cached verdict if possible'
+        # values of wildcards are shared, eval_pattern must not be modified
+        eval_pattern = deepcopy(pattern)
+        EvalPattern(self.wildcards, copy=False).visit(eval_pattern)
+        key = (asttools.get_canonical_key(target),
+               asttools.get_canonical_key(eval_pattern), self.nbits)
+        verdict = EQ_CACHE.get(key)
+        if verdict is not None:
+            return verdict
+        if VERDICT_STORE is not None:
+            verdict = VERDICT_STORE.get(("eq",) + key)
+        if verdict is None:
+            verdict = self.prove_eq_z3(target, eval_pattern)
+            if verdict is None:
+                # out of budget: no match, but do not remember it
+                return False
+            if VERDICT_STORE is not None:
+                VERDICT_STORE.set(("eq",) + key, verdict)
+        EQ_CACHE.set(key, verdict)
+        return verdict
+
+    def prove_eq_z3(self, target, eval_pattern):
+        """
+        Prove equivalence of target and evaluated pattern with z3,
+        return None if solver could not answer within its budget
+        """
+        z3 = load_z3()
         getid = asttools.GetIdentifiers()
         getid.visit(target)
         if getid.functions:
@@ -101,34 +369,30 @@ class PatternMatcher(asttools.Comparator):
             # does not seem to support function declaration with
             # arbitrary number of arguments
             return False
-        for var in self.variables:
-            exec("%s = z3.BitVec('%s', %d)" % (var, var, self.nbits))
-        target_ast = deepcopy(target)
-        target_ast = Unflattening().visit(target_ast)
-        ast.fix_missing_locations(target_ast)
-        code1 = compile(ast.Expression(target_ast), '<string>', mode='eval')
-        eval_pattern = deepcopy(pattern)
-        EvalPattern(self.wildcards).visit(eval_pattern)
-        eval_pattern = Unflattening().visit(eval_pattern)
-        ast.fix_missing_locations(eval_pattern)
-        getid.reset()
-        getid.visit(eval_pattern)
-        if getid.functions:
+        gvar = asttools.GetIdentifiers()
+        gvar.visit(eval_pattern)
+        if gvar.functions:
             # same reason as before, not using Z3 if there are
             # functions
             return False
-        gvar = asttools.GetIdentifiers()
-        gvar.visit(eval_pattern)
         if any(var.isupper() for var in gvar.variables):
             # do not check if all patterns have not been replaced
             return False
-        code2 = compile(ast.Expression(eval_pattern), '<string>', mode='eval')
-        sol = z3.Solver()
-        if isinstance(eval(code1), int) and eval(code1) == 0:
+        term1 = self.translator.visit(target)
+        if isinstance(term1, int) and term1 == 0:
             # cases where target == 0 are too permissive
             return False
-        sol.add(eval(code1) != eval(code2))
-        return sol.check().r == -1
+        if REFUTATION:
+            variables = gvar.variables | getid.variables
+            if evaluator.refute(target, eval_pattern, variables,
+                                self.nbits, REFUTATION_SAMPLES):
+                STATS["refuted"] += 1
+                return False
+        term2 = self.translator.visit(eval_pattern)
+        result = self.check_sat(term1 != term2)[0]
+        if result == z3.unknown:
+            return None
+        return result == z3.unsat
 
     def check_wildcard(self, target, pattern):
         'Check wildcard value or affect it'
@@ -147,7 +411,6 @@ class PatternMatcher(asttools.Comparator):
 
     def get_model(self, target, pattern):
         'When target is constant and wildcards have no value yet'
-        # pylint: disable=exec-used
         if target.n == 0:
             # zero is too permissive
             return False
@@ -171,21 +434,67 @@ class PatternMatcher(asttools.Comparator):
             EvalPattern(self.wildcards).visit(folded)
             folded = asttools.ConstFolding(folded, self.nbits).visit(folded)
             return folded.n == target.n
-        else:
-            exec("%s = z3.BitVec('%s', %d)" % (wil, wil, self.nbits))
-        eval_pattern = deepcopy(pattern)
-        eval_pattern = Unflattening().visit(eval_pattern)
-        ast.fix_missing_locations(eval_pattern)
-        code = compile(ast.Expression(eval_pattern), '<string>', mode='eval')
-        sol = z3.Solver()
-        sol.add(target.n == eval(code))
-        if sol.check().r == 1:
-            model = sol.model()
-            for inst in model.decls():
-                self.wildcards[str(inst)] = ast.Num(int(model[inst].as_long()))
-            return True
+        query = ("model", target.n, asttools.get_canonical_key(pattern),
+                 self.nbits)
+        model = None
+        if VERDICT_STORE is not None:
+            model = VERDICT_STORE.get(query)
+        if model is None:
+            model = self.solve_model(target, pattern)
+            if model is None:
+                # out of budget
+                return False
+            if VERDICT_STORE is not None:
+                VERDICT_STORE.set(query, model)
+        if model is False:
+            return False
+        for name, value in model.items():
+            self.wildcards[str(name)] = ast.Num(value)
+        return True
+
+    def solve_model(self, target, pattern):
+        'Find value of wildcard so that pattern is equal to target'
+        z3 = load_z3()
+        result, values = self.check_sat(target.n ==
+                                        self.translator.visit(pattern))
+        if result == z3.sat:
+            return values
+        if result == z3.unknown:
+            return None
         return False
 
+    def check_sat(self, constraint):
+        """
+        Check satisfiability of constraint, return result of z3 and
+        values of variables in the model if constraint is satisfiable.
+        Result is z3.unknown if query is out of BUDGET.
+        """
+        z3 = load_z3()
+        if BUDGET.exhausted():
+            STATS["z3_skipped"] += 1
+            return z3.unknown, None
+        BUDGET.queries += 1
+        STATS["z3_queries"] += 1
+        start = time.time()
+        sol = get_solver(self.nbits)
+        sol.push()
+        try:
+            BUDGET.configure(sol)
+            sol.add(constraint)
+            result = sol.check()
+            values = None
+            if result == z3.sat:
+                model = sol.model()
+                values = {}
+                for inst in model.decls():
+                    values[str(inst)] = int(model[inst].as_long())
+            elif result == z3.unknown:
+                STATS["z3_unknown"] += 1
+        finally:
+            sol.pop()
+            STATS["z3_time"] += time.time() - start
+        return result, values
+
     def check_not(self, target, pattern):
         'Check NOT pattern node that could be in another form'
         if self.is_wildcard(pattern.operand):
@@ -315,6 +624,12 @@ class PatternMatcher(asttools.Comparator):
     def visit(self, target, pattern):
         'Deal with corner cases before using classic comparison'
 
+        # use specialized routine of compiled pattern if available
+        if self.routines is not None:
+            routine = self.routines.get(id(pattern))
+            if routine is not None:
+                return routine(self, target, pattern)
+
         # if pattern contains is a wildcard, check value against target
         # or affect it
         if self.is_wildcard(pattern):
@@ -353,26 +668,26 @@ class PatternMatcher(asttools.Comparator):
 
         # if operation is commutative, left and right operands are
         # interchangeable
-        previous_state = deepcopy(self.wildcards)
+        previous_state = self.wildcards.mark()
         cond1 = (self.visit(target.left, pattern.left) and
                  self.visit(target.right, pattern.right))
-        state = asttools.apply_hooks()
-        nos = self.wildcards in self.no_solution
-        asttools.restore_hooks(state)
+        nos = (bool(self.no_solution) and
+               self.wildcards.key() in self.no_solution)
         if cond1 and not nos:
             return True
         if nos:
-            self.wildcards = deepcopy(previous_state)
+            self.wildcards.undo(previous_state)
         if not cond1 and not nos:
             # different visiting order might give different results
-            wildsbackup = deepcopy(self.wildcards)
-            self.wildcards = deepcopy(previous_state)
+            wildsbackup = self.wildcards.changes(previous_state)
+            self.wildcards.undo(previous_state)
             cond1_prime = (self.visit(target.right, pattern.right) and
                            self.visit(target.left, pattern.left))
             if cond1_prime:
                 return True
             else:
-                self.wildcards = deepcopy(wildsbackup)
+                self.wildcards.undo(previous_state)
+                self.wildcards.redo(wildsbackup)
 
         # commutative operators
         if isinstance(target.op, (ast.Add, ast.Mult,
@@ -381,19 +696,20 @@ class PatternMatcher(asttools.Comparator):
                      self.visit(target.right, pattern.left))
             if cond2:
                 return True
-            wildsbackup = deepcopy(self.wildcards)
-            self.wildcards = deepcopy(previous_state)
+            wildsbackup = self.wildcards.changes(previous_state)
+            self.wildcards.undo(previous_state)
             cond2_prime = (self.visit(target.right, pattern.left) and
                            self.visit(target.left, pattern.right))
             if cond2_prime:
                 return True
             else:
-                self.wildcards = deepcopy(wildsbackup)
+                self.wildcards.undo(previous_state)
+                self.wildcards.redo(wildsbackup)
 
             # if those affectations don't work, try with another order
             if target == self.root:
-                self.no_solution.append(self.wildcards)
-                self.wildcards = deepcopy(previous_state)
+                self.no_solution.add(self.wildcards.key())
+                self.wildcards.undo(previous_state)
                 cond1 = (self.visit(target.left, pattern.left) and
                          self.visit(target.right, pattern.right))
                 if cond1:
@@ -401,26 +717,60 @@ class PatternMatcher(asttools.Comparator):
                 cond2 = (self.visit(target.left, pattern.right)
                          and self.visit(target.right, pattern.left))
                 return cond1 or cond2
-        self.wildcards = deepcopy(previous_state)
+        self.wildcards.undo(previous_state)
         return False
 
+    def could_match(self, target, pattern):
+        'Cheap check: return False if pattern can not match target'
+        # pylint: disable=too-many-return-statements
+        if self.is_wildcard(pattern):
+            return True
+        multnode = (isinstance(pattern, ast.BinOp) and
+                    isinstance(pattern.op, ast.Mult))
+        if type(target) != type(pattern):
+            if not FLEXIBLE:
+                return False
+            notnode = (isinstance(pattern, ast.UnaryOp) and
+                       isinstance(pattern.op, ast.Invert))
+            return isinstance(target, ast.Num) or notnode or multnode
+        if isinstance(pattern, ast.BinOp):
+            return (type(target.op) == type(pattern.op) or
+                    (FLEXIBLE and multnode))
+        if isinstance(pattern, ast.UnaryOp):
+            return type(target.op) == type(pattern.op)
+        if isinstance(pattern, ast.BoolOp):
+            return (type(target.op) == type(pattern.op) and
+                    len(target.values) == len(pattern.values))
+        if isinstance(pattern, ast.Num):
+            return self.visit_Num(target, pattern)
+        if isinstance(pattern, ast.Name):
+            return target.id == pattern.id
+        return True
+
     def visit_BoolOp(self, target, pattern):
         'Match pattern on flattened operators of same length and same type'
         conds = (type(target.op) == type(pattern.op) and
                  len(target.values) == len(pattern.values))
         if not conds:
             return False
-        # try every combination wildcard <=> value
-        old_context = deepcopy(self.wildcards)
-        for perm in itertools.permutations(target.values):
-            self.wildcards = deepcopy(old_context)
-            res = True
-            i = 0
-            for i in range(len(pattern.values)):
-                res &= self.visit(perm[i], pattern.values[i])
-            if res:
-                return res
-        return False
+        # values of target each operand of pattern could be matched on
+        candidates = [[j for j, value in enumerate(target.values)
+                       if self.could_match(value, patt)]
+                      for patt in pattern.values]
+        if not has_complete_assignment(candidates):
+            return False
+        # operands are assigned in the order of the pattern, and values
+        # in the order of the target, so that the first match found is
+        # the same as with a search on all permutations
+        wilds = []
+        for patt in pattern.values:
+            getwild = asttools.GetIdentifiers()
+            getwild.visit(patt)
+            wilds.append(sorted(var for var in getwild.variables
+                                if var.isupper()))
+        search = OperandsSearch(self, target.values, pattern.values,
+                                candidates, wilds)
+        return search.run()
 
     def visit_UnaryOp(self, target, pattern):
         'Match type of UnaryOp and operands'
@@ -446,6 +796,107 @@ class PatternMatcher(asttools.Comparator):
         return True
 
 
+class OperandsSearch(object):
+    """
+    Backtracking search of an assignment of the operands of a flattened
+    target to the operands of a flattened pattern, such that each
+    pattern operand matches its value.
+
+    Matching a pattern operand only depends on the values of its own
+    wildcards: failures are memoized for these values, so that the
+    same (operand, value) pair is never tried twice in the same context.
+    """
+
+    def __init__(self, matcher, values, patterns, candidates, wilds):
+        'wilds[i] is the list of wildcards of patterns[i]'
+        self.matcher = matcher
+        self.values = values
+        self.patterns = patterns
+        self.candidates = candidates
+        self.wilds = wilds
+        self.used = set()
+        # (i, j, ids of values of wildcards) of failed matchings
+        self.failures = set()
+        # values referenced in failures, kept so that ids are not re-used
+        self.alive = []
+
+    def context(self, i):
+        'Values of wildcards of pattern i'
+        bindings = self.matcher.wildcards
+        return tuple(bindings.get(wil) for wil in self.wilds[i])
+
+    def run(self, i=0):
+        'Assign operands from i, return True if a full assignment is found'
+        if i == len(self.patterns):
+            return True
+        bindings = self.matcher.wildcards
+        mark = bindings.mark()
+        context = self.context(i)
+        ids = tuple(id(value) for value in context)
+        for j in self.candidates[i]:
+            if j in self.used or (i, j, ids) in self.failures:
+                continue
+            if self.matcher.visit(self.values[j], self.patterns[i]):
+                self.used.add(j)
+                if self.run(i + 1):
+                    return True
+                self.used.remove(j)
+            elif not self.matcher.no_solution:
+                # (with known no-solution states, matching depends on
+                # all wildcards)
+                self.failures.add((i, j, ids))
+                self.alive.append(context)
+            bindings.undo(mark)
+        return False
+
+
+def get_head(node):
+    'Return class of the operator of node, or class of node'
+    if isinstance(node, (ast.BinOp, ast.BoolOp, ast.UnaryOp)):
+        return type(node.op)
+    return type(node)
+
+
+def get_pattern_head(patt_ast):
+    """
+    Return the head (see get_head) a node must have to be matched by
+    pattern patt_ast in PatternReplacement, or None if pattern could
+    match any node.
+    """
+    if PatternMatcher.is_wildcard(patt_ast):
+        return None
+    # c*X, -X and ~X might be matched on anything by check_pattern
+    multnode = (isinstance(patt_ast, ast.BinOp) and
+                isinstance(patt_ast.op, ast.Mult))
+    notnode = (isinstance(patt_ast, ast.UnaryOp) and
+               isinstance(patt_ast.op, ast.Invert))
+    if multnode or notnode:
+        return None
+    return get_head(patt_ast)
+
+
+def has_complete_assignment(candidates):
+    """
+    Check that each pattern operand i can be assigned a distinct target
+    operand among candidates[i] (bipartite matching with augmenting
+    paths).
+    """
+    owner = {}
+
+    def augment(i, seen):
+        'Try to assign a target operand to pattern operand i'
+        for j in candidates[i]:
+            if j in seen:
+                continue
+            seen.add(j)
+            if j not in owner or augment(owner[j], seen):
+                owner[j] = i
+                return True
+        return False
+
+    return all(augment(i, set()) for i in range(len(candidates)))
+
+
 def match(target_str, pattern_str):
     'Apply all pre-processing, then pattern matcher'
     target_ast = ast.parse(target_str, mode="eval").body
@@ -463,8 +914,26 @@ class PatternReplacement(ast.NodeTransformer):
     and replace it if found.
     """
 
-    def __init__(self, patt_ast, target_ast, rep_ast, nbits=0):
-        'Pattern ast should have as root: BinOp, BoolOp, UnaryOp or Call'
+    def __init__(self, patt_ast, target_ast, rep_ast, nbits=0,
+                 failures=None, keys=None):
+        """
+        Pattern ast should have as root: BinOp, BoolOp, UnaryOp or Call,
+        it can also be given as a CompiledPattern.
+        failures is a set of keys of subterms where pattern is not
+        found, updated by visit; these subterms are skipped. keys gives
+        the key of each subterm of the visited ast by id (see
+        asttools.get_subterm_keys).
+        """
+        # pylint: disable=too-many-arguments
+        self.failures = failures
+        self.keys = keys
+        # number of replacements and of subterms skipped
+        self.replaced = 0
+        self.skipped = 0
+        self.compiled = None
+        if isinstance(patt_ast, CompiledPattern):
+            self.compiled = patt_ast
+            patt_ast = patt_ast.patt_ast
         if isinstance(patt_ast, ast.Module):
             self.patt_ast = patt_ast.body[0].value
         elif isinstance(patt_ast, ast.Expression):
@@ -488,14 +957,36 @@ class PatternReplacement(ast.NodeTransformer):
                 self.nbits = 8
         else:
             self.nbits = nbits
+        self.head = get_pattern_head(self.patt_ast)
+
+    def visit(self, node):
+        'Visit node, unless pattern was already not found in it'
+        if self.failures is None or not isinstance(
+                node, (ast.BinOp, ast.BoolOp, ast.UnaryOp, ast.Call)):
+            return ast.NodeTransformer.visit(self, node)
+        key = self.keys[id(node)]
+        if key in self.failures:
+            self.skipped += 1
+            return node
+        replaced = self.replaced
+        unanswered = STATS["z3_skipped"] + STATS["z3_unknown"]
+        new_node = ast.NodeTransformer.visit(self, node)
+        # a query out of budget may have hidden a match
+        if (self.replaced == replaced and
+                STATS["z3_skipped"] + STATS["z3_unknown"] == unanswered):
+            self.failures.add(key)
+        return new_node
 
     def basic_visit(self, node):
         'Check if node is matching the pattern, if not, visit children'
-        pat = PatternMatcher(node, self.nbits)
+        if self.head is not None and get_head(node) != self.head:
+            return self.generic_visit(node)
+        pat = PatternMatcher(node, self.nbits, self.compiled)
         matched = pat.visit(node, self.patt_ast)
         if matched:
             repc = deepcopy(self.rep_ast)
             new_node = EvalPattern(pat.wildcards).visit(repc)
+            self.replaced += 1
             return new_node
         else:
             return self.generic_visit(node)
@@ -518,18 +1009,20 @@ class PatternReplacement(ast.NodeTransformer):
         if isinstance(self.patt_ast, ast.BoolOp):
             if len(node.values) == len(self.patt_ast.values):
                 return self.basic_visit(node)
-            elif len(node.values) > len(self.patt_ast.values):
+            elif (len(node.values) > len(self.patt_ast.values) and
+                  type(node.op) == type(self.patt_ast.op)):
                 # associativity n to m
                 for combi in itertools.combinations(node.values,
                                                     len(self.patt_ast.values)):
                     rest = [elem for elem in node.values if elem not in combi]
                     testnode = ast.BoolOp(node.op, list(combi))
-                    pat = PatternMatcher(testnode, self.nbits)
+                    pat = PatternMatcher(testnode, self.nbits, self.compiled)
                     matched = pat.visit(testnode, self.patt_ast)
                     if matched:
                         new = EvalPattern(pat.wildcards).visit(self.rep_ast)
                         new = ast.BoolOp(node.op, [new] + rest)
                         new = Unflattening().visit(new)
+                        self.replaced += 1
                         return new
             return self.generic_visit(node)
 
@@ -540,12 +1033,13 @@ class PatternReplacement(ast.NodeTransformer):
             for combi in itertools.combinations(node.values, 2):
                 rest = [elem for elem in node.values if elem not in combi]
                 testnode = ast.BinOp(combi[0], op, combi[1])
-                pat = PatternMatcher(testnode, self.nbits)
+                pat = PatternMatcher(testnode, self.nbits, self.compiled)
                 matched = pat.visit(testnode, self.patt_ast)
                 if matched:
                     new_node = EvalPattern(pat.wildcards).visit(self.rep_ast)
                     new_node = ast.BoolOp(op, [new_node] + rest)
                     new_node = Unflattening().visit(new_node)
+                    self.replaced += 1
                     return new_node
         return self.generic_visit(node)
 
@@ -575,4 +1069,4 @@ if __name__ == '__main__':
     out = replace(test, patt_string, repl)
     print ast.dump(out)
     out = Unflattening().visit(out)
-    print astunparse.unparse(out)
+    print asttools.unparse(out)
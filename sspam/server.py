@@ -0,0 +1,271 @@
+"""Simplification server on a Unix domain socket.
+
+The server keeps warm worker processes (rules compiled, sympy and z3
+loaded, caches filled by previous requests) so that interactive tools
+do not pay the startup of sspam for each expression.
+
+Protocol is one json object per line, in both directions:
+
+  - request: {"id": ..., "expr": ..., "nbits": ..., "timeout": ...}
+    (nbits and timeout, in seconds, are optional)
+  - cancellation of a request: {"cancel": id}
+  - response: {"id": ..., "result": ..., "time": ..., "stats": ...},
+    {"id": ..., "error": ...}, {"id": ..., "cancelled": true} or
+    {"id": ..., "timeout": true}
+
+A simplifier.SimplificationBudget given to the server applies to each
+request: unlike the timeout of a request, it keeps the smallest result
+found so far, and marks the response as partial. Likewise, each worker
+orders rules with its own copy of a simplifier.RuleScheduler, which
+learns from the requests it answers.
+
+Several clients can be connected at once, and a client can have
+several requests in progress: responses are sent as soon as they are
+available, not necessarily in the order of requests. A request that is
+cancelled or runs out of its time budget is stopped by killing its
+worker, which is replaced by a new one. A worker that dies (killed or
+crashed) is replaced as well, and its request gets an error response.
+"""
+
+import json
+import multiprocessing
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+
+from sspam import parallel, simplifier
+
+
+# seconds between checks of cancellation and timeout of a request
+POLL_INTERVAL = 0.05
+
+
+def worker_loop(conn, custom_rules=None, use_default=True, budget=None,
+                scheduler=None):
+    'Simplify records received on conn until it is closed'
+    # pylint: disable=too-many-arguments
+    # warm up: compile rules, load sympy and z3
+    simplifier.simplify("(x ^ y) + 2*(x & y)", 8, custom_rules, use_default)
+    while True:
+        try:
+            record = conn.recv()
+        except EOFError:
+            return
+        conn.send(parallel.simplify_record(record, 0, custom_rules,
+                                           use_default, budget, scheduler))
+
+
+def check_request(request):
+    'Return why request (a dict) is invalid, or None if it is valid'
+    for field in ("id", "cancel"):
+        try:
+            hash(request.get(field))
+        except TypeError:
+            return "%s must be a number or a string" % field
+    timeout = request.get("timeout")
+    if timeout is not None and (
+            isinstance(timeout, bool) or
+            not isinstance(timeout, (int, long, float)) or timeout < 0):
+        return "timeout must be a positive number"
+    return None
+
+
+class Worker(object):
+    """
+    A worker process and the pipe used to send it records.
+    """
+
+    def __init__(self, custom_rules=None, use_default=True, budget=None,
+                 scheduler=None):
+        'Start worker process'
+        self.custom_rules = custom_rules
+        self.use_default = use_default
+        self.budget = budget
+        self.scheduler = scheduler
+        self.conn = None
+        self.process = None
+        self.start()
+
+    def start(self):
+        'Start a new worker process'
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_loop,
+                                               args=(child,
+                                                     self.custom_rules,
+                                                     self.use_default,
+                                                     self.budget,
+                                                     self.scheduler))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        'Kill worker process'
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+
+    def restart(self):
+        'Replace worker process with a new one'
+        self.stop()
+        self.start()
+
+    def run(self, record, cancelled):
+        """
+        Return response of the worker to record, or restart worker and
+        return a cancellation, timeout or error (if worker died)
+        response
+        """
+        timeout = record.get("timeout")
+        start = time.time()
+        try:
+            self.conn.send(record)
+            while True:
+                interval = POLL_INTERVAL
+                if timeout:
+                    interval = min(interval, start + timeout - time.time())
+                if cancelled.is_set():
+                    response = {"cancelled": True}
+                elif interval <= 0:
+                    response = {"timeout": True}
+                elif self.conn.poll(interval):
+                    return self.conn.recv()
+                else:
+                    continue
+                break
+        except (EOFError, IOError):
+            response = {"error": "worker process died"}
+        self.restart()
+        return response
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handle requests of one client, each one in its own thread.
+    """
+
+    def setup(self):
+        'Init lock on output and pending requests'
+        SocketServer.StreamRequestHandler.setup(self)
+        self.lock = threading.Lock()
+        # id -> event set when request is cancelled
+        self.pending = {}
+
+    def send(self, response):
+        'Send response to the client'
+        with self.lock:
+            try:
+                self.wfile.write(json.dumps(response) + "\n")
+                self.wfile.flush()
+            except (socket.error, ValueError):
+                # client is gone
+                pass
+
+    def handle(self):
+        'Read requests until client disconnects'
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a json object")
+            except ValueError as exc:
+                self.send({"id": None, "error": str(exc)})
+                continue
+            error = check_request(request)
+            if error is not None:
+                self.send({"id": request.get("id"), "error": error})
+                continue
+            if "cancel" in request:
+                cancelled = self.pending.get(request["cancel"])
+                if cancelled is not None:
+                    cancelled.set()
+                continue
+            cancelled = threading.Event()
+            self.pending[request.get("id")] = cancelled
+            thread = threading.Thread(target=self.process,
+                                      args=(request, cancelled))
+            thread.daemon = True
+            thread.start()
+        # nobody is waiting for results anymore
+        for cancelled in self.pending.values():
+            cancelled.set()
+
+    def process(self, request, cancelled):
+        'Simplify request on a worker and send response'
+        response = self.server.simplify(request, cancelled)
+        response["id"] = request.get("id")
+        if self.pending.get(request.get("id")) is cancelled:
+            del self.pending[request.get("id")]
+        self.send(response)
+
+
+class SimplificationServer(SocketServer.ThreadingMixIn,
+                           SocketServer.UnixStreamServer):
+    """
+    Server answering simplification requests with a pool of workers.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, workers=1, custom_rules=None, use_default=True,
+                 budget=None, scheduler=None):
+        'Start workers and listen on path'
+        # pylint: disable=too-many-arguments
+        self.workers = [Worker(custom_rules, use_default, budget, scheduler)
+                        for _ in range(workers)]
+        self.idle = Queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def simplify(self, request, cancelled):
+        'Wait for an idle worker and run request on it'
+        start = time.time()
+        timeout = request.get("timeout")
+        while True:
+            if cancelled.is_set():
+                return {"cancelled": True}
+            if timeout and time.time() - start > timeout:
+                return {"timeout": True}
+            try:
+                worker = self.idle.get(timeout=POLL_INTERVAL)
+                break
+            except Queue.Empty:
+                pass
+        try:
+            if timeout:
+                # remaining time, which must not be 0 (no timeout)
+                remaining = max(timeout - (time.time() - start), 1e-9)
+                request = dict(request, timeout=remaining)
+            return worker.run(request, cancelled)
+        finally:
+            self.idle.put(worker)
+
+    def server_close(self):
+        'Stop workers and remove socket'
+        SocketServer.UnixStreamServer.server_close(self)
+        for worker in self.workers:
+            worker.stop()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def serve(path, workers=1, custom_rules=None, use_default=True,
+          budget=None, scheduler=None):
+    'Run simplification server on path until interrupted'
+    # pylint: disable=too-many-arguments
+    server = SimplificationServer(path, workers, custom_rules, use_default,
+                                  budget, scheduler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -6,19 +6,45 @@ Principal loop is in simplify() function:
   - flattening of add (highly dependant of used rules in MBA
     obfuscation)
   - test each pattern if replacement is possible (does not break if
-    replaced, so will try all patterns remaining)
+    replaced, so will try all patterns remaining) ; patterns are
+    indexed by their root operator (RuleIndex) so that only patterns
+    that might match a subterm are tried
   - bitwise simplification on XOR only (to be generalized)
   - basic constant folding
   - arithmetic simplification
   - pass to compute constant values according to the current modulus
+
+Time spent in each stage, fixpoint iterations and attempts of each
+rule are reported in a SimplificationStats (see simplify_stats()).
+
+Rules are tried in the order of the rules list, or by increasing
+expected cost of a match observed in previous simplifications with a
+RuleScheduler.
+
+Subterms where a rule was not found are remembered during a
+simplification (if MEMOIZE is set), so that following fixpoint
+iterations only try rules on subterms that changed. Subterms are
+identified by integer keys computed once per iteration (see
+asttools.get_subterm_keys), and a subterm where the solver ran out of
+budget is not remembered.
+
+A SimplificationBudget bounds the wall time and the number of fixpoint
+iterations of a simplification: when it runs out, the smallest
+expression seen so far is returned and the result is marked as partial.
 """
 
 import ast
-from astunparse import unparse
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import cPickle
 from copy import deepcopy
+import itertools
+import json
 import os.path
+import time
 
 from sspam.tools import asttools
+from sspam.tools.asttools import unparse
 from sspam.tools.flattening import Flattening, Unflattening
 from sspam import pattern_matcher
 from sspam.pre_processing import all_preprocessings
@@ -55,6 +81,287 @@ DEFAULT_RULES = [("(A ^ ~B) + 2*(A | B)", "A + B - 1"),
 
 DEBUG = False
 
+# remember (rule, subterm) pairs that did not match during a
+# simplification, see PatternReplacement
+MEMOIZE = True
+
+
+class RuleIndex(object):
+    """
+    Index of rules by the operator (head) a subterm must have to be
+    matched by their pattern, so that rules that can not match any
+    subterm of an expression are not tried on it.
+    """
+
+    def __init__(self, patterns):
+        'Index list of (pattern, replacement)'
+        self.patterns = patterns
+        # head -> indices of rules
+        self.by_head = {}
+        # indices of rules whose pattern could match any subterm
+        self.universal = []
+        for i, (patt_ast, _) in enumerate(patterns):
+            head = pattern_matcher.get_pattern_head(patt_ast)
+            if head is None:
+                self.universal.append(i)
+            else:
+                self.by_head.setdefault(head, []).append(i)
+
+    def candidates(self, expr_ast):
+        'Return indices of rules that might match in expr_ast'
+        heads = set()
+        # maximum number of operands of flattened operators
+        arity = {}
+        for node in ast.walk(expr_ast):
+            head = pattern_matcher.get_head(node)
+            heads.add(head)
+            if isinstance(node, ast.BoolOp):
+                arity[head] = max(arity.get(head, 0), len(node.values))
+        indices = set(self.universal)
+        for head in heads:
+            for i in self.by_head.get(head, []):
+                patt_ast = self.patterns[i][0]
+                if isinstance(patt_ast, ast.BoolOp):
+                    if arity.get(head, 0) < len(patt_ast.values):
+                        continue
+                indices.add(i)
+        return sorted(indices)
+
+
+# compiled rules (patterns, compiled patterns and index) for each rules
+# list and number of bits, so that rules are compiled once per process
+COMPILED_RULES = {}
+
+
+def compile_rules(rules_list, nbits):
+    'Return (patterns, compiled patterns, index) of rules_list on nbits'
+    key = (tuple(rules_list), nbits)
+    if key not in COMPILED_RULES:
+        patterns = []
+        for pattern, replace in rules_list:
+            patt_ast = ast.parse(pattern, mode="eval").body
+            patt_ast = all_preprocessings(patt_ast, nbits)
+            patt_ast = Flattening(ast.Add).visit(patt_ast)
+            rep_ast = ast.parse(replace, mode="eval").body
+            patterns.append((patt_ast, rep_ast))
+        compiled = [pattern_matcher.CompiledPattern(compiled_ast)
+                    for compiled_ast, _ in patterns]
+        COMPILED_RULES[key] = (patterns, compiled, RuleIndex(patterns))
+    return COMPILED_RULES[key]
+
+
+# change this if the format of saved rules changes
+RULES_FORMAT_VERSION = 1
+
+
+def save_rules(path, rules_list, nbits_list=(8, 16, 32, 64)):
+    """
+    Save rules_list, with its patterns and replacements pre-processed
+    for each number of bits of nbits_list, in file path.
+    """
+    trees = {}
+    for nbits in nbits_list:
+        trees[nbits] = compile_rules(rules_list, nbits)[0]
+    with open(path, 'wb') as output:
+        cPickle.dump((RULES_FORMAT_VERSION, list(rules_list), trees),
+                     output, cPickle.HIGHEST_PROTOCOL)
+
+
+def load_rules(path):
+    """
+    Load rules saved by save_rules, so that they don't need to be
+    compiled again, and return the rules list.
+    """
+    with open(path, 'rb') as input_file:
+        version, rules_list, trees = cPickle.load(input_file)
+    if version != RULES_FORMAT_VERSION:
+        raise Exception("%s: unsupported rules format version %s"
+                        % (path, version))
+    for nbits, patterns in trees.items():
+        key = (tuple(rules_list), nbits)
+        if key not in COMPILED_RULES:
+            compiled = [pattern_matcher.CompiledPattern(patt_ast)
+                        for patt_ast, _ in patterns]
+            COMPILED_RULES[key] = (patterns, compiled, RuleIndex(patterns))
+    return rules_list
+
+
+class RuleScheduler(object):
+    """
+    Adaptive order of rules: candidate rules are tried by increasing
+    expected cost of finding a match, that is the mean time of an
+    attempt divided by the rate of matches, both observed in previous
+    simplifications (see update). Rules never tried come first, in the
+    order of the rules list.
+
+    As the first matching rule is applied, the order may change the
+    result (it is still equivalent), so scheduling is optional.
+    Counters can be saved as a profile and loaded in later runs.
+    """
+
+    def __init__(self):
+        'Init counters'
+        # pattern -> Counter of attempts, matches, time
+        self.rules = {}
+
+    def update(self, stats):
+        'Add counters of rules of a SimplificationStats'
+        for pattern, counters in stats.rules.items():
+            self.rules.setdefault(pattern, Counter()).update(
+                dict((name, counters[name])
+                     for name in ("attempts", "matches", "time")))
+
+    def cost(self, pattern):
+        'Expected time to find a match with rule of pattern'
+        counters = self.rules.get(pattern)
+        if not counters or not counters["attempts"]:
+            return 0.
+        # rate of matches, never 0 for rules without matches yet
+        rate = (counters["matches"] + 1.)/(counters["attempts"] + 2.)
+        return counters["time"]/counters["attempts"]/rate
+
+    def order(self, candidates, rules_list):
+        'Return indices of candidate rules of rules_list in trying order'
+        # sorting is stable: same costs keep order of rules list
+        return sorted(candidates, key=lambda i: self.cost(rules_list[i][0]))
+
+    def save(self, path):
+        'Save counters as json in file path'
+        with open(path, 'w') as output:
+            json.dump(dict((pattern, dict(counters))
+                           for pattern, counters in self.rules.items()),
+                      output, indent=2, sort_keys=True)
+
+    def load(self, path):
+        'Add counters saved in file path'
+        with open(path, 'r') as input_file:
+            for pattern, counters in json.load(input_file).items():
+                self.rules.setdefault(pattern, Counter()).update(counters)
+
+
+class SimplificationBudget(object):
+    """
+    Limits of a simplification: wall time in seconds and number of
+    fixpoint iterations (steps) for the whole expression or program
+    (see reset). Zero means no limit.
+
+    Budget is only checked between steps and rule attempts: an
+    arithmetic simplification or a solver query in progress is never
+    interrupted (see pattern_matcher.SolverBudget to bound queries).
+    """
+
+    def __init__(self, timeout=0, max_steps=0):
+        'Init limits and steps done'
+        self.timeout = timeout
+        self.max_steps = max_steps
+        self.deadline = None
+        self.steps = 0
+
+    def reset(self):
+        'Start a new simplification'
+        self.deadline = None
+        if self.timeout:
+            self.deadline = time.time() + self.timeout
+        self.steps = 0
+
+    def exhausted(self):
+        'Return True if simplification should stop'
+        if self.max_steps and self.steps >= self.max_steps:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+
+def expr_size(node):
+    'Size of an expression, used to compare results of fixpoint iterations'
+    return len(unparse(node))
+
+
+def copy_subterms(node, keys=None):
+    """
+    Return copy of node, and keys of its subterms by id if keys of
+    subterms of node are given (see asttools.get_subterm_keys)
+    """
+    copy = deepcopy(node)
+    if keys is None:
+        return copy, None
+    # both trees are walked in the same order
+    return copy, dict((id(copied), keys[id(subterm)]) for subterm, copied
+                      in itertools.izip(ast.walk(node), ast.walk(copy)))
+
+
+class SimplificationStats(object):
+    """
+    Statistics of a simplification: wall time of each stage, number of
+    fixpoint iterations, and for each rule the number of attempts,
+    matches, z3 queries, time spent matching it and subterms skipped
+    because it did not match them before.
+
+    partial is True if the simplification ran out of its budget.
+    """
+
+    def __init__(self):
+        'Init counters'
+        self.times = Counter()
+        self.iterations = 0
+        self.partial = False
+        # pattern -> Counter of attempts, matches, z3_queries, time,
+        # skipped
+        self.rules = OrderedDict()
+        # solver counters of pattern_matcher.STATS during simplification
+        self.solver = Counter()
+
+    @contextmanager
+    def stage(self, name):
+        'Add time spent in the block to stage name'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] += time.time() - start
+
+    def add_rule(self, pattern, matched, z3_queries, elapsed):
+        'Record an attempt of rule with given pattern'
+        counters = self.rules.setdefault(pattern, Counter())
+        counters["attempts"] += 1
+        counters["matches"] += int(matched)
+        counters["z3_queries"] += z3_queries
+        counters["time"] += elapsed
+
+    def skip_rule(self, pattern, skipped=1):
+        'Record subterms skipped by rule because it did not match before'
+        counters = self.rules.setdefault(pattern, Counter())
+        counters["skipped"] += skipped
+
+    def as_dict(self):
+        'Return statistics as a dict of builtin types (for json)'
+        return {"times": dict(self.times), "iterations": self.iterations,
+                "partial": self.partial,
+                "rules": OrderedDict((pattern, dict(counters))
+                                     for pattern, counters
+                                     in self.rules.items()),
+                "solver": dict(self.solver)}
+
+    def report(self):
+        'Return statistics as human-readable text'
+        lines = ["total time: %.3fs" % sum(self.times.values()),
+                 "fixpoint iterations: %d" % self.iterations]
+        if self.partial:
+            lines.append("partial result: out of budget")
+        for name, value in self.times.most_common():
+            lines.append("  %-16s %8.3fs" % (name, value))
+        for name, value in sorted(self.solver.items()):
+            lines.append("solver %s: %s" % (name, value))
+        lines.append("%8s %8s %8s %8s %8s  %s"
+                     % ("attempts", "matches", "z3", "time", "skipped",
+                        "rule"))
+        for pattern, counters in sorted(self.rules.items(),
+                                        key=lambda item: -item[1]["time"]):
+            lines.append("%8d %8d %8d %7.3fs %8d  %s"
+                         % (counters["attempts"], counters["matches"],
+                            counters["z3_queries"], counters["time"],
+                            counters["skipped"], pattern))
+        return "\n".join(lines)
+
 
 class Simplifier(ast.NodeTransformer):
     """
@@ -65,61 +372,134 @@ class Simplifier(ast.NodeTransformer):
     - arithmetic simplification with z3
     - updating variable value for further replacement
     """
+    # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, nbits, rules_list=DEFAULT_RULES):
+    def __init__(self, nbits, rules_list=DEFAULT_RULES, stats=None,
+                 budget=None, scheduler=None):
         'Init context : correspondance between variables and values'
-        # pylint: disable=dangerous-default-value
+        # pylint: disable=dangerous-default-value,too-many-arguments
         self.context = {}
         self.nbits = nbits
+        self.rules_list = rules_list
+        self.stats = stats or SimplificationStats()
+        self.budget = budget or SimplificationBudget()
+        self.scheduler = scheduler
+        # set when matching is stopped by the budget
+        self.interrupted = False
+        # rule index -> keys of subterms where it did not match, and
+        # structures of subterms -> keys (see asttools.get_subterm_keys),
+        # kept during the whole simplification
+        self.failures = {}
+        self.keys = {}
+        # patterns are never modified, so they are shared between
+        # simplifiers
+        with self.stats.stage("compile_rules"):
+            self.patterns, self.compiled, self.index = compile_rules(
+                rules_list, nbits)
 
-        self.patterns = []
-        for pattern, replace in rules_list:
-            patt_ast = ast.parse(pattern, mode="eval").body
-            patt_ast = all_preprocessings(patt_ast, self.nbits)
-            patt_ast = Flattening(ast.Add).visit(patt_ast)
-            rep_ast = ast.parse(replace, mode="eval").body
-            self.patterns.append((patt_ast, rep_ast))
+    def apply_rule(self, i, expr_ast, keys=None):
+        """
+        Return expr_ast with i-th rule applied, or None if it does not
+        match; keys are keys of subterms of expr_ast if MEMOIZE is set
+        """
+        pattern, repl = self.patterns[i]
+        failures = None
+        if keys is not None:
+            failures = self.failures.setdefault(i, set())
+            if keys[id(expr_ast)] in failures:
+                # nothing changed since last attempt of this rule
+                self.stats.skip_rule(self.rules_list[i][0])
+                return None
+        with self.stats.stage("copy"):
+            copy_ast, copy_keys = copy_subterms(expr_ast, keys)
+        queries = pattern_matcher.STATS["z3_queries"]
+        start = time.time()
+        rep = pattern_matcher.PatternReplacement(self.compiled[i], expr_ast,
+                                                 repl, self.nbits, failures,
+                                                 copy_keys)
+        new_ast = rep.visit(copy_ast)
+        matched = not asttools.Comparator().visit(new_ast, expr_ast)
+        elapsed = time.time() - start
+        self.stats.times["matching"] += elapsed
+        self.stats.add_rule(self.rules_list[i][0], matched,
+                            pattern_matcher.STATS["z3_queries"] - queries,
+                            elapsed)
+        if rep.skipped:
+            self.stats.skip_rule(self.rules_list[i][0], rep.skipped)
+        if not matched:
+            return None
+        if DEBUG:
+            print "replaced! "
+            dispat = deepcopy(pattern)
+            dispat = Unflattening().visit(dispat)
+            print "pattern:  ", unparse(dispat)
+            disnew = deepcopy(new_ast)
+            disnew = Unflattening().visit(disnew)
+            print "after:    ", unparse(disnew)
+            print ""
+        return new_ast
 
     def simplify(self, expr_ast, nbits):
         'Apply pattern matching and arithmetic simplification'
-        expr_ast = arithm_simpl.run(expr_ast, nbits)
-        expr_ast = asttools.GetConstMod(self.nbits).visit(expr_ast)
+        self.stats.iterations += 1
+        with self.stats.stage("arithm_simpl"):
+            expr_ast = arithm_simpl.run(expr_ast, nbits)
+            expr_ast = asttools.GetConstMod(self.nbits).visit(expr_ast)
         if DEBUG:
             print "arithm simpl: "
             print unparse(expr_ast)
         if DEBUG:
             print "before matching: "
             print unparse(expr_ast)
-        expr_ast = all_preprocessings(expr_ast, self.nbits)
-        # only flattening ADD nodes because of traditionnal MBA patterns
-        expr_ast = Flattening(ast.Add).visit(expr_ast)
-        for pattern, repl in self.patterns:
-            rep = pattern_matcher.PatternReplacement(pattern, expr_ast, repl)
-            new_ast = rep.visit(deepcopy(expr_ast))
-            if not asttools.Comparator().visit(new_ast, expr_ast):
-                if DEBUG:
-                    print "replaced! "
-                    dispat = deepcopy(pattern)
-                    dispat = Unflattening().visit(dispat)
-                    print "pattern:  ", unparse(dispat)
-                    disnew = deepcopy(new_ast)
-                    disnew = Unflattening().visit(disnew)
-                    print "after:    ", unparse(disnew)
-                    print ""
+        with self.stats.stage("pre_processing"):
+            expr_ast = all_preprocessings(expr_ast, self.nbits)
+            # only flattening ADD nodes because of traditionnal MBA
+            # patterns
+            expr_ast = Flattening(ast.Add).visit(expr_ast)
+        with self.stats.stage("matching"):
+            candidates = self.index.candidates(expr_ast)
+            if self.scheduler is not None:
+                candidates = self.scheduler.order(candidates,
+                                                  self.rules_list)
+        keys = None
+        if MEMOIZE:
+            keys = asttools.get_subterm_keys(expr_ast, self.keys)
+        for i in candidates:
+            if self.budget.exhausted():
+                self.interrupted = True
+                break
+            new_ast = self.apply_rule(i, expr_ast, keys)
+            if new_ast is not None:
                 expr_ast = new_ast
                 break
         # bitwise simplification: this is a ugly hack, should be
         # "generalized"
-        expr_ast = Flattening(ast.BitXor).visit(expr_ast)
-        expr_ast = asttools.ConstFolding(expr_ast, self.nbits).visit(expr_ast)
-        expr_ast = Unflattening().visit(expr_ast)
+        with self.stats.stage("folding"):
+            expr_ast = Flattening(ast.BitXor).visit(expr_ast)
+            expr_ast = asttools.ConstFolding(expr_ast,
+                                             self.nbits).visit(expr_ast)
+            expr_ast = Unflattening().visit(expr_ast)
         if DEBUG:
             print "after PM: "
             print unparse(expr_ast)
+        self.budget.steps += 1
         return expr_ast
 
     def loop_simplify(self, node):
-        'Simplifying loop to reach fixpoint'
+        """
+        Simplifying loop to reach fixpoint, or the smallest value seen
+        if budget runs out before
+        """
+        # time not spent in other stages is spent checking fixpoint
+        start = time.time()
+        staged = sum(self.stats.times.values())
+        best = deepcopy(node.value)
+        best_size = expr_size(best)
+        if self.budget.exhausted():
+            self.stats.partial = True
+            return node
+        partial = False
+        self.interrupted = False
         old_value = deepcopy(node.value)
         old_value = Flattening().visit(old_value)
         node.value = self.simplify(node.value, self.nbits)
@@ -127,6 +507,12 @@ class Simplifier(ast.NodeTransformer):
         copyvalue = Flattening().visit(copyvalue)
         # simplify until fixpoint is reached
         while not asttools.Comparator().visit(old_value, copyvalue):
+            if expr_size(node.value) < best_size:
+                best = deepcopy(node.value)
+                best_size = expr_size(best)
+            if self.budget.exhausted():
+                partial = True
+                break
             old_value = deepcopy(node.value)
             node.value = self.simplify(node.value, self.nbits)
             copyvalue = deepcopy(node.value)
@@ -136,6 +522,9 @@ class Simplifier(ast.NodeTransformer):
             copyvalue = Flattening().visit(copyvalue)
             old_value = Flattening().visit(old_value)
             if asttools.Comparator().visit(old_value, copyvalue):
+                if self.budget.exhausted():
+                    partial = True
+                    break
                 old_value = deepcopy(node.value)
                 node.value = NotToInv().visit(node.value)
                 node.value = self.simplify(node.value, self.nbits)
@@ -148,9 +537,18 @@ class Simplifier(ast.NodeTransformer):
                 old_value = Flattening().visit(old_value)
             if DEBUG:
                 print "-"*80
+        self.stats.times["fixpoint"] += (time.time() - start -
+                                         sum(self.stats.times.values()) +
+                                         staged)
+        if partial or self.interrupted:
+            self.stats.partial = True
+            if expr_size(node.value) > best_size:
+                node.value = best
+            return node
         # final arithmetic simplification to clean output of matching
-        node.value = arithm_simpl.run(node.value, self.nbits)
-        asttools.GetConstMod(self.nbits).visit(node.value)
+        with self.stats.stage("arithm_simpl"):
+            node.value = arithm_simpl.run(node.value, self.nbits)
+            asttools.GetConstMod(self.nbits).visit(node.value)
         if DEBUG:
             print "arithm simpl: "
             print unparse(node.value)
@@ -162,8 +560,9 @@ class Simplifier(ast.NodeTransformer):
         'Simplify value of assignment and update context'
 
         # use EvalPattern to replace known variables
-        node.value = pattern_matcher.EvalPattern(
-            self.context).visit(node.value)
+        with self.stats.stage("substitution"):
+            node.value = pattern_matcher.EvalPattern(
+                self.context).visit(node.value)
         node = self.loop_simplify(node)
         for target in node.targets:
             self.context[target.id] = node.value
@@ -174,7 +573,25 @@ class Simplifier(ast.NodeTransformer):
         return self.loop_simplify(node)
 
 
-def simplify(expr, nbits=0, custom_rules=None, use_default=True):
+def parse_input(expr):
+    'Return ast of expr, which is either a file name or an expression'
+    if os.path.isfile(expr):
+        expr_file = open(expr, 'r')
+        return ast.parse(expr_file.read())
+    return ast.parse(expr)
+
+
+def get_rules_list(custom_rules=None, use_default=True):
+    'Return rules to use given custom rules and use of default ones'
+    if not use_default:
+        return custom_rules
+    if not custom_rules:
+        return DEFAULT_RULES
+    return DEFAULT_RULES + custom_rules
+
+
+def simplify(expr, nbits=0, custom_rules=None, use_default=True,
+             budget=None, scheduler=None):
     """
     Take an expression and an optionnal number of bits as input.
 
@@ -184,23 +601,47 @@ def simplify(expr, nbits=0, custom_rules=None, use_default=True):
     If not precised, number of bits will be deduced from the highest
     constant of the expression if possible, else it will be 8.
 
+    An optional SimplificationBudget limits time and fixpoint
+    iterations of the simplification (use simplify_stats to know if
+    the result is partial).
+
+    An optional RuleScheduler orders rules, and is updated with the
+    statistics of the simplification.
+
     """
+    # pylint: disable=too-many-arguments
+    return simplify_stats(expr, nbits, custom_rules, use_default,
+                          budget, scheduler)[0]
 
-    if os.path.isfile(expr):
-        expr_file = open(expr, 'r')
-        expr_ast = ast.parse(expr_file.read())
-    else:
-        expr_ast = ast.parse(expr)
+
+def simplify_stats(expr, nbits=0, custom_rules=None, use_default=True,
+                   budget=None, scheduler=None):
+    """
+    Same as simplify, but return a tuple (simplified expression,
+    SimplificationStats of the simplification).
+    """
+    # pylint: disable=too-many-arguments
+    stats = SimplificationStats()
+    solver_before = pattern_matcher.STATS.copy()
+    with stats.stage("parse"):
+        expr_ast = parse_input(expr)
 
     nbits = nbits
     if not nbits:
         nbits = asttools.get_default_nbits(expr_ast)
 
-    if not use_default:
-        rules_list = custom_rules
-    elif not custom_rules:
-        rules_list = DEFAULT_RULES
-    else:
-        rules_list = DEFAULT_RULES + custom_rules
-    expr_ast = Simplifier(nbits, rules_list).visit(expr_ast)
-    return unparse(expr_ast).strip('\n')
+    rules_list = get_rules_list(custom_rules, use_default)
+    pattern_matcher.BUDGET.reset()
+    if budget is not None:
+        budget.reset()
+    expr_ast = Simplifier(nbits, rules_list, stats, budget,
+                          scheduler).visit(expr_ast)
+    if scheduler is not None:
+        scheduler.update(stats)
+    with stats.stage("unparse"):
+        result = unparse(expr_ast).strip('\n')
+    stats.solver = pattern_matcher.STATS.copy()
+    stats.solver.subtract(solver_before)
+    stats.solver = Counter(dict((name, value) for name, value
+                                in stats.solver.items() if value))
+    return result, stats
@@ -2,4 +2,7 @@
 
 - asttools: functions and classes to analyze and manipulate ast
 - cse: script applying common subexpression elimination
+- evaluator: evaluation of expressions on random inputs
+- generator: generation of obfuscated MBA expressions
+- z3_translator: translation of ast into z3 terms
 """
@@ -4,6 +4,12 @@
   ast.
 - get_default_nbits returns the default bitsize of an ast if it is
   different from zero, returns 8 otherwise.
+- get_canonical_key returns a hashable key of an ast, invariant by
+  commutativity of operators.
+- get_subterm_keys gives integer keys to the subterms of an ast, equal
+  subterms sharing the same key.
+- unparse returns source code of an ast (astunparse is imported on
+  first use).
 - GetIdentifiers collects every identifiers of an ast.
 - GetNums collects all numerals of an ast.
 - GetSize computes the default bitsize of an ast from its constants.
@@ -22,6 +28,12 @@ import ast
 from sspam.tools.flattening import Unflattening
 
 
+def unparse(node):
+    'Return source code of node'
+    import astunparse
+    return astunparse.unparse(node)
+
+
 def flatten(lis):
     'Flatten a list'
     res = []
@@ -76,6 +88,73 @@ def get_default_nbits(expr_ast):
     return nbits
 
 
+COMMUTATIVE_OPERATORS = (ast.Add, ast.Mult, ast.BitAnd, ast.BitOr, ast.BitXor)
+
+
+def get_canonical_key(node):
+    """
+    Compute a string key of an ast such that two ast equivalent modulo
+    commutativity (and order of flattened operands) share the same key.
+    """
+    if isinstance(node, ast.Num):
+        return str(node.n)
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.BinOp):
+        children = [get_canonical_key(node.left),
+                    get_canonical_key(node.right)]
+        if isinstance(node.op, COMMUTATIVE_OPERATORS):
+            children.sort()
+        return "%s(%s)" % (type(node.op).__name__, ",".join(children))
+    if isinstance(node, ast.BoolOp):
+        children = sorted(get_canonical_key(child) for child in node.values)
+        return "%s[%s]" % (type(node.op).__name__, ",".join(children))
+    if isinstance(node, ast.UnaryOp):
+        return "%s(%s)" % (type(node.op).__name__,
+                           get_canonical_key(node.operand))
+    if isinstance(node, ast.Call):
+        return "%s{%s}" % (get_canonical_key(node.func),
+                           ",".join(get_canonical_key(arg)
+                                    for arg in node.args))
+    if isinstance(node, ast.Expression):
+        return get_canonical_key(node.body)
+    if isinstance(node, ast.Expr):
+        return get_canonical_key(node.value)
+    if isinstance(node, ast.Module):
+        return ";".join(get_canonical_key(stmt) for stmt in node.body)
+    return ast.dump(node)
+
+
+def get_subterm_keys(node, table):
+    """
+    Return dict id of subterm -> key of every subterm of node, subterms
+    with the same structure (as ast.dump) having the same key. Keys are
+    integers given by table (structure -> key, with keys of children in
+    structure), so that keys computed with the same table can be
+    compared.
+    """
+    keys = {}
+
+    def get_key(node):
+        'Compute key of node from keys of its children'
+        fields = []
+        for _, value in ast.iter_fields(node):
+            if isinstance(value, ast.AST):
+                value = get_key(value)
+            elif isinstance(value, list):
+                value = tuple(get_key(elem) if isinstance(elem, ast.AST)
+                              else (type(elem), elem) for elem in value)
+            else:
+                # 1, 1L and 1.0 are different terms
+                value = (type(value), value)
+            fields.append(value)
+        key = table.setdefault((type(node), tuple(fields)), len(table))
+        keys[id(node)] = key
+        return key
+    get_key(node)
+    return keys
+
+
 class GetIdentifiers(ast.NodeVisitor):
     """
     Get all identifiers (instances of ast.Name) of an ast.
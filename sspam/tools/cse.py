@@ -2,7 +2,6 @@
 """
 
 import ast
-import astunparse
 import functools
 from copy import deepcopy
 import sys
@@ -411,7 +410,7 @@ def apply_cse(expr, outputfile=None):
     HandleCommutativity().visit(expr_ast)
     simple_cse(expr_ast)
     expr_ast = PostProcessing().visit(expr_ast)
-    expr_string = astunparse.unparse(expr_ast).strip('\n')
+    expr_string = asttools.unparse(expr_ast).strip('\n')
     if outputfile:
         output_file = open(outputfile, 'w')
         output_file.write(expr_string)
@@ -11,7 +11,6 @@ Main function applies to input:
 """
 import sys
 import ast
-import pygraphviz
 import argparse
 import random
 import time
@@ -41,6 +40,8 @@ class DAGTranslator(ast.NodeVisitor):
 
     def __init__(self, input_ast):
         'Init graph, subexpr list, set of ids (for op node) and variables'
+        # pygraphviz is only needed (and imported) to build graphs
+        import pygraphviz
         self.graph = pygraphviz.AGraph(directed=True, rankdir='TB')
         self.subexpr = {}
         self.variables = set()
@@ -0,0 +1,133 @@
+"""Evaluation of expressions on random values.
+
+Evaluating two expressions on a few random inputs is a very cheap way
+to prove that they are *not* equivalent, and thus to avoid calling a
+solver on most wrong candidates of the pattern matcher.
+
+Expressions are evaluated on all inputs at once: each node is visited
+only once and returns the list of its values (one per input), so the
+cost of walking the ast is shared by all inputs.
+
+Only operators whose semantics on bit-vectors are obvious are
+supported (+, -, *, &, |, ^, ~, <<); Unsupported is raised for other
+nodes, and refute() then conservatively answers False.
+"""
+
+import ast
+import random
+
+
+class Unsupported(Exception):
+    """
+    Raised when the expression contains nodes that can't be evaluated.
+    """
+    pass
+
+
+# values used for i-th variable of an expression, computed once for
+# each (nbits, number of inputs, i)
+SAMPLES = {}
+
+
+def get_samples(nbits, count, index):
+    'Return list of count values on nbits used for index-th variable'
+    key = (nbits, count, index)
+    if key not in SAMPLES:
+        rand = random.Random(nbits*1000003 + count*1009 + index)
+        mask = 2**nbits - 1
+        # corner cases first
+        values = [0, 1, mask][:count]
+        while len(values) < count:
+            values.append(rand.getrandbits(nbits) & mask)
+        SAMPLES[key] = values
+    return SAMPLES[key]
+
+
+class Evaluator(ast.NodeVisitor):
+    """
+    Evaluate an ast modulo 2**nbits on a list of inputs at once.
+    """
+
+    def __init__(self, nbits, inputs, count):
+        'Inputs is a dict giving the list of count values of each variable'
+        self.mask = 2**nbits - 1
+        self.nbits = nbits
+        self.inputs = inputs
+        self.count = count
+
+    def generic_visit(self, node):
+        'Nodes without visit_ method are not supported'
+        raise Unsupported(node.__class__.__name__)
+
+    def visit_Expression(self, node):
+        'Evaluate body'
+        return self.visit(node.body)
+
+    def visit_Num(self, node):
+        'A constant has the same value for each input'
+        return [node.n & self.mask]*self.count
+
+    def visit_Name(self, node):
+        'Values of a variable are given by inputs'
+        if node.id not in self.inputs:
+            raise Unsupported(node.id)
+        return self.inputs[node.id]
+
+    def apply(self, op, left, right):
+        'Apply binary operator op on lists of values'
+        mask = self.mask
+        if isinstance(op, ast.Add):
+            return [(a + b) & mask for a, b in zip(left, right)]
+        if isinstance(op, ast.Sub):
+            return [(a - b) & mask for a, b in zip(left, right)]
+        if isinstance(op, ast.Mult):
+            return [(a*b) & mask for a, b in zip(left, right)]
+        if isinstance(op, ast.BitAnd):
+            return [a & b for a, b in zip(left, right)]
+        if isinstance(op, ast.BitOr):
+            return [a | b for a, b in zip(left, right)]
+        if isinstance(op, ast.BitXor):
+            return [a ^ b for a, b in zip(left, right)]
+        if isinstance(op, ast.LShift):
+            return [(a << b) & mask if b < self.nbits else 0
+                    for a, b in zip(left, right)]
+        raise Unsupported(op.__class__.__name__)
+
+    def visit_BinOp(self, node):
+        'Evaluate operands, then operation'
+        return self.apply(node.op, self.visit(node.left),
+                          self.visit(node.right))
+
+    def visit_BoolOp(self, node):
+        'Evaluate flattened operator'
+        values = [self.visit(child) for child in node.values]
+        result = values[0]
+        for operand in values[1:]:
+            result = self.apply(node.op, result, operand)
+        return result
+
+    def visit_UnaryOp(self, node):
+        'Evaluate operand, then operation'
+        operand = self.visit(node.operand)
+        if isinstance(node.op, ast.Invert):
+            return [~a & self.mask for a in operand]
+        if isinstance(node.op, ast.USub):
+            return [-a & self.mask for a in operand]
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        raise Unsupported(node.op.__class__.__name__)
+
+
+def refute(expr1, expr2, variables, nbits, count=32):
+    """
+    Return True if expr1 and expr2 are proven different by evaluating
+    them on count inputs, False if they might be equivalent.
+    """
+    inputs = {}
+    for index, var in enumerate(sorted(variables)):
+        inputs[var] = get_samples(nbits, count, index)
+    evaluator = Evaluator(nbits, inputs, count)
+    try:
+        return evaluator.visit(expr1) != evaluator.visit(expr2)
+    except Unsupported:
+        return False
@@ -0,0 +1,207 @@
+"""Generator of obfuscated MBA expressions.
+
+A random ground truth (a sum of simple terms) is obfuscated by:
+  - rewriting operations with the rules of the simplifier used in
+    reverse: a node matching the replacement of a rule (like A + B) is
+    replaced with its pattern (like (A ^ B) + 2*(A & B)), wildcards
+    not appearing in the replacement getting random values;
+  - affine encodings (as in tests/samples/z1_sample): a subterm e is
+    replaced with a'*(a*e + b) + c, with a odd, a' its inverse and
+    c = -a'*b modulo 2**nbits.
+
+Size of the output is controlled by the number of terms and variables
+of the ground truth and the number of obfuscation passes (depth), and
+the same seed always gives the same output. Each output comes with its
+ground truth, which the simplifier is expected to find.
+"""
+
+import argparse
+import ast
+from copy import deepcopy
+import random
+import sys
+
+from sspam import simplifier
+from sspam.pattern_matcher import EvalPattern
+from sspam.tools import asttools
+
+
+# operators used to build ground truth
+TRUTH_OPERATORS = [ast.Add, ast.Sub, ast.BitXor, ast.BitAnd, ast.BitOr]
+
+WILDCARDS = {"A", "B"}
+
+
+def get_reverse_rules(rules_list):
+    """
+    Return, for each operator, the list of (pattern, wildcards of the
+    replacement) of rules whose replacement is that operator applied
+    on two wildcards; rules whose replacement is a single wildcard are
+    indexed by None.
+    """
+    reverse = {}
+    for pattern, replacement in rules_list:
+        patt_ast = ast.parse(pattern, mode="eval").body
+        rep_ast = ast.parse(replacement, mode="eval").body
+        if isinstance(rep_ast, ast.Name) and rep_ast.id in WILDCARDS:
+            reverse.setdefault(None, []).append((patt_ast, [rep_ast.id]))
+        elif (isinstance(rep_ast, ast.BinOp) and
+              isinstance(rep_ast.left, ast.Name) and
+              isinstance(rep_ast.right, ast.Name) and
+              {rep_ast.left.id, rep_ast.right.id} == WILDCARDS):
+            reverse.setdefault(type(rep_ast.op), []).append(
+                (patt_ast, [rep_ast.left.id, rep_ast.right.id]))
+    return reverse
+
+
+class Obfuscator(ast.NodeTransformer):
+    """
+    One obfuscation pass: rewrite some operations with reverse rules,
+    and apply affine encodings on some of the rewritten nodes.
+    """
+
+    def __init__(self, generator, targets):
+        'Use random source and parameters of generator'
+        self.gen = generator
+        # ids of nodes to rewrite
+        self.targets = targets
+
+    def visit_BinOp(self, node):
+        'Obfuscate operands first, then the operation itself'
+        self.generic_visit(node)
+        if id(node) not in self.targets:
+            return node
+        pattern, names = self.gen.rand.choice(self.gen.reverse[type(node.op)])
+        return self.encode(self.rewrite(pattern, names,
+                                        [node.left, node.right]))
+
+    def rewrite(self, pattern, names, values):
+        'Instantiate pattern with values of names, others are random'
+        wildcards = dict(zip(names, values))
+        for name in WILDCARDS - set(names):
+            wildcards[name] = self.gen.random_operand()
+        return EvalPattern(wildcards).visit(deepcopy(pattern))
+
+    def encode(self, node):
+        'Apply an affine encoding on node with probability gen.affine'
+        if self.gen.rand.random() >= self.gen.affine:
+            return node
+        mask = 2**self.gen.nbits - 1
+        mult = int(self.gen.rand.getrandbits(self.gen.nbits) | 1)
+        # odd numbers modulo 2**n form a group of order 2**(n - 1)
+        inverse = pow(mult, 2**(self.gen.nbits - 1) - 1, 2**self.gen.nbits)
+        add = int(self.gen.rand.getrandbits(self.gen.nbits))
+        encoded = ast.BinOp(ast.BinOp(ast.Num(mult), ast.Mult(), node),
+                            ast.Add(), ast.Num(add))
+        decoded = ast.BinOp(ast.Num(inverse), ast.Mult(), encoded)
+        return ast.BinOp(decoded, ast.Add(),
+                         ast.Num(int(-inverse*add & mask)))
+
+
+class MBAGenerator(object):
+    """
+    Generate obfuscated expressions with their ground truth.
+    """
+
+    def __init__(self, nbits=8, nvars=2, terms=2, depth=1, seed=None,
+                 affine=0.1, rules_list=None):
+        'Parameters of generated expressions, seed of random source'
+        # pylint: disable=too-many-arguments
+        self.nbits = nbits
+        self.variables = ["x", "y", "z", "t", "u", "v", "w"][:nvars]
+        if nvars > 7:
+            self.variables += ["v%d" % i for i in range(nvars - 7)]
+        self.terms = terms
+        self.depth = depth
+        self.affine = affine
+        self.rand = random.Random(seed)
+        if rules_list is None:
+            rules_list = simplifier.DEFAULT_RULES
+        self.reverse = get_reverse_rules(rules_list)
+
+    def random_operand(self):
+        'Return a variable or a constant'
+        if self.rand.random() < 0.25:
+            return ast.Num(int(self.rand.getrandbits(self.nbits)))
+        return ast.Name(self.rand.choice(self.variables), ast.Load())
+
+    def random_constant(self):
+        'Return a constant different from 0 and -1 (absorbing values)'
+        return ast.Num(int(self.rand.randint(1, 2**self.nbits - 2)))
+
+    def ground_truth(self):
+        """
+        Return a random sum of terms, each one being an operation
+        between a variable and a constant or another variable (so that
+        no term is trivial, like x - x or x & 0)
+        """
+        truth = None
+        for _ in range(self.terms):
+            op = self.rand.choice(TRUTH_OPERATORS)()
+            var = self.rand.choice(self.variables)
+            others = [other for other in self.variables if other != var]
+            if others and self.rand.random() >= 0.25:
+                operand = ast.Name(self.rand.choice(others), ast.Load())
+            else:
+                operand = self.random_constant()
+            term = ast.BinOp(ast.Name(var, ast.Load()), op, operand)
+            if truth is None:
+                truth = term
+            else:
+                truth = ast.BinOp(truth, ast.Add(), term)
+        return truth
+
+    def generate(self):
+        'Return (obfuscated expression, ground truth) as strings'
+        truth = self.ground_truth()
+        expr_ast = deepcopy(truth)
+        for _ in range(self.depth):
+            # a rewriting duplicates operands, so only a few nodes are
+            # rewritten at each pass to keep growth under control
+            nodes = [node for node in ast.walk(expr_ast)
+                     if isinstance(node, ast.BinOp) and
+                     type(node.op) in self.reverse]
+            targets = set(id(node) for node in
+                          self.rand.sample(nodes, min(len(nodes),
+                                                      self.terms)))
+            obfuscator = Obfuscator(self, targets)
+            expr_ast = obfuscator.visit(expr_ast)
+            # rules whose replacement is a single wildcard apply on
+            # any subterm, here on the whole expression
+            single = self.reverse.get(None, [])
+            if single and self.rand.random() < 0.5:
+                pattern, names = self.rand.choice(single)
+                expr_ast = obfuscator.rewrite(pattern, names, [expr_ast])
+        return (asttools.unparse(expr_ast).strip('\n'),
+                asttools.unparse(truth).strip('\n'))
+
+
+def main(args):
+    'Print generated expressions and their ground truth'
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="nbits", type=int, default=8,
+                        help="number of bits (default is 8)")
+    parser.add_argument("--vars", dest="nvars", type=int, default=2,
+                        help="number of variables (default is 2)")
+    parser.add_argument("--terms", type=int, default=2,
+                        help="number of terms of ground truth (default "
+                        "is 2)")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="number of obfuscation passes (default is 1)")
+    parser.add_argument("--affine", type=float, default=0.1,
+                        help="probability of affine encoding of each "
+                        "rewritten operation (default is 0.1)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--count", type=int, default=1,
+                        help="number of expressions to generate")
+    args = parser.parse_args(args)
+    gen = MBAGenerator(args.nbits, args.nvars, args.terms, args.depth,
+                       args.seed, args.affine)
+    for _ in range(args.count):
+        expr, truth = gen.generate()
+        print "# %s" % truth
+        print expr
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
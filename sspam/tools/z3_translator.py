@@ -0,0 +1,107 @@
+"""Translation of ast into z3 terms.
+
+This replaces the previous approach of declaring variables with exec()
+and evaluating compiled expressions, which created Python code objects
+for each solver query.
+
+Operators are applied on z3 terms with their Python semantics (as
+eval() would have done), so constant sub-expressions are translated
+into Python integers and flattened operators (BoolOp) are rebuilt the
+same way as Unflattening does.
+
+z3 is imported on first use (see load_z3), so that importing sspam
+stays cheap.
+"""
+
+import ast
+import operator
+
+
+def load_z3():
+    'Import z3 module, which is slow to import, and return it'
+    try:
+        import z3
+    except ImportError:
+        raise Exception("z3 module is needed to use this translator")
+    return z3
+
+
+BINARY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub,
+                    ast.Mult: operator.mul, ast.Div: operator.div,
+                    ast.Mod: operator.mod, ast.Pow: operator.pow,
+                    ast.BitAnd: operator.and_, ast.BitOr: operator.or_,
+                    ast.BitXor: operator.xor, ast.LShift: operator.lshift,
+                    ast.RShift: operator.rshift}
+
+UNARY_OPERATORS = {ast.Invert: operator.invert, ast.USub: operator.neg,
+                   ast.UAdd: operator.pos}
+
+
+# BitVec symbols of variables, for each number of bits
+SYMBOLS = {}
+
+
+def get_symbol(name, nbits):
+    'Return z3 BitVec symbol of variable name on nbits'
+    key = (name, nbits)
+    if key not in SYMBOLS:
+        SYMBOLS[key] = load_z3().BitVec(name, nbits)
+    return SYMBOLS[key]
+
+
+class Z3Translator(object):
+    """
+    Translate ast nodes into z3 terms, memoizing translation of each
+    node (nodes are supposed not to be modified once translated).
+    """
+
+    def __init__(self, nbits):
+        'Init memoization table'
+        self.nbits = nbits
+        # id(node) -> (node, term), node is kept to ensure id is not
+        # re-used by another node
+        self.memo = {}
+
+    def visit(self, node):
+        'Return z3 term (or Python integer) corresponding to node'
+        entry = self.memo.get(id(node))
+        if entry is not None and entry[0] is node:
+            return entry[1]
+        nodetype = node.__class__.__name__
+        translate = getattr(self, "visit_%s" % nodetype, None)
+        if not translate:
+            raise Exception("no translation function for %s" % nodetype)
+        term = translate(node)
+        self.memo[id(node)] = (node, term)
+        return term
+
+    def visit_Expression(self, node):
+        'Translate body'
+        return self.visit(node.body)
+
+    def visit_Num(self, node):
+        'Constants are kept as Python integers'
+        # pylint: disable=no-self-use
+        return node.n
+
+    def visit_Name(self, node):
+        'Variables are BitVec symbols'
+        return get_symbol(node.id, self.nbits)
+
+    def visit_BinOp(self, node):
+        'Apply operator on translated operands'
+        return BINARY_OPERATORS[type(node.op)](self.visit(node.left),
+                                               self.visit(node.right))
+
+    def visit_BoolOp(self, node):
+        'Apply operator as if flattened node was unflattened'
+        operation = BINARY_OPERATORS[type(node.op)]
+        operands = [self.visit(child) for child in node.values]
+        term = operation(operands[-2], operands[-1])
+        for operand in operands[-3::-1]:
+            term = operation(operand, term)
+        return term
+
+    def visit_UnaryOp(self, node):
+        'Apply operator on translated operand'
+        return UNARY_OPERATORS[type(node.op)](self.visit(node.operand))
@@ -0,0 +1,101 @@
+"""Persistent store of solver verdicts.
+
+The pattern matcher asks z3 the same equivalence queries again and
+again, including in separate sspam processes simplifying expressions
+produced by the same obfuscator. This module provides a store, backed
+by a SQLite file, that can be shared between runs and worker processes
+to avoid calling the solver on queries that were already answered.
+
+Queries are identified by a sha1 hash of their canonical form (see
+asttools.get_canonical_key), and verdicts are stored as json. When the
+number of entries exceeds the size cap, oldest entries are evicted.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+
+# change this if the meaning of stored verdicts changes
+FORMAT_VERSION = 1
+
+
+class VerdictStore(object):
+    """
+    SQLite-backed mapping from solver queries to their verdicts.
+    """
+
+    def __init__(self, path, maxsize=1000000):
+        'Connection is opened lazily, so that the store survives forks'
+        self.path = path
+        self.maxsize = maxsize
+        self.conn = None
+        self.pid = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        'Return connection to the database for the current process'
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            self.pid = os.getpid()
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS verdicts "
+                              "(key TEXT PRIMARY KEY, verdict TEXT)")
+            self.conn.commit()
+            self.size = self.conn.execute(
+                "SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        return self.conn
+
+    @staticmethod
+    def hash_query(query):
+        'Compute key of a query (a tuple of strings and integers)'
+        text = "|".join(str(elem) for elem in (FORMAT_VERSION,) + query)
+        return hashlib.sha1(text).hexdigest()
+
+    def get(self, query):
+        'Return stored verdict of query, or None if it is unknown'
+        row = self.connect().execute(
+            "SELECT verdict FROM verdicts WHERE key = ?",
+            (self.hash_query(query),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, query, verdict):
+        'Store verdict of query, evicting oldest entries if needed'
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?)",
+                         (self.hash_query(query), json.dumps(verdict)))
+        self.size += 1
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        'Remove oldest entries so that store is filled at 90%'
+        conn = self.connect()
+        with conn:
+            self.size = conn.execute(
+                "SELECT COUNT(*) FROM verdicts").fetchone()[0]
+            excess = self.size - (self.maxsize*9)/10
+            if excess > 0:
+                conn.execute("DELETE FROM verdicts WHERE rowid IN (SELECT "
+                             "rowid FROM verdicts ORDER BY rowid LIMIT ?)",
+                             (excess,))
+                self.size -= excess
+
+    def stats(self):
+        'Return counters of the store'
+        return {"size": self.size, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        'Close connection to the database'
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
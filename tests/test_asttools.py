@@ -8,6 +8,7 @@
 - TestReplaceBitwiseFunctions
 - TestGetConstMod
 - TestComparator
+- TestGetCanonicalKey
 """
 # pylint: disable=relative-import
 
@@ -209,5 +210,55 @@ class TestComparator(unittest.TestCase):
         self.assertTrue(asttools.Comparator().visit(expr_a, expr_b))
 
 
+class TestGetCanonicalKey(unittest.TestCase):
+    """
+    Test canonical keys of ast.
+    """
+
+    def test_commutativity(self):
+        'Equivalent ast modulo commutativity share the same key'
+        tests = [("x + 2*y", "y*2 + x"), ("(a & b) ^ ~c", "~c ^ (b & a)"),
+                 ("f(x + 1)", "f(1 + x)")]
+        for string_a, string_b in tests:
+            key_a = asttools.get_canonical_key(ast.parse(string_a))
+            key_b = asttools.get_canonical_key(ast.parse(string_b))
+            self.assertEquals(key_a, key_b)
+        key_a = asttools.get_canonical_key(ast.parse("x - y"))
+        key_b = asttools.get_canonical_key(ast.parse("y - x"))
+        self.assertNotEquals(key_a, key_b)
+
+    def test_flattened(self):
+        'Order of flattened operands does not matter'
+        expr_a = Flattening().visit(ast.parse("x + y + 3 + z"))
+        expr_b = Flattening().visit(ast.parse("z + (3 + (y + x))"))
+        self.assertEquals(asttools.get_canonical_key(expr_a),
+                          asttools.get_canonical_key(expr_b))
+
+
+class TestGetSubtermKeys(unittest.TestCase):
+    """
+    Test keys of subterms.
+    """
+
+    def test_keys(self):
+        'Equal subterms share a key, other subterms do not'
+        table = {}
+        expr = ast.parse("(x + y) * (x + y) - (y + x)", mode="eval").body
+        keys = asttools.get_subterm_keys(expr, table)
+        self.assertEquals(set(keys), set(id(node) for node in ast.walk(expr)))
+        left, right = expr.left.left, expr.left.right
+        self.assertEquals(keys[id(left)], keys[id(right)])
+        self.assertNotEquals(keys[id(left)], keys[id(expr.right)])
+        self.assertNotEquals(keys[id(expr)], keys[id(expr.left)])
+        # same table gives same keys, numbers of other types differ
+        other = ast.parse("x + y", mode="eval").body
+        self.assertEquals(asttools.get_subterm_keys(other, table)[id(other)],
+                          keys[id(left)])
+        nums = ast.parse("[1, 1L, 1.0]", mode="eval").body.elts
+        keys = [asttools.get_subterm_keys(num, table)[id(num)]
+                for num in nums]
+        self.assertEquals(len(set(keys)), 3)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,126 @@
+"""Tests for egraph module.
+"""
+
+import ast
+import unittest
+
+from sspam import egraph, simplifier
+from sspam.pre_processing import all_preprocessings
+from sspam.tools import evaluator
+from sspam.tools.generator import MBAGenerator
+
+
+class TestEGraph(unittest.TestCase):
+    """
+    Tests for EGraph class.
+    """
+
+    def test_hashcons(self):
+        'Common subterms are only added once'
+        graph = egraph.EGraph(8)
+        cid1 = graph.add(ast.parse("(x & y) + (x & y)", mode="eval").body)
+        cid2 = graph.add(ast.parse("x & y", mode="eval").body)
+        self.assertEquals(graph.size(), 4)
+        self.assertIn(("Add", None, (cid2, cid2)), graph.classes[cid1])
+
+    def test_congruence(self):
+        'Union of classes merges classes of their parents'
+        graph = egraph.EGraph(8)
+        cid1 = graph.add(ast.parse("(x + 0) & y", mode="eval").body)
+        cid2 = graph.add(ast.parse("x & y", mode="eval").body)
+        self.assertNotEquals(graph.find(cid1), graph.find(cid2))
+        graph.union(graph.add(ast.parse("x + 0", mode="eval").body),
+                    graph.add(ast.parse("x", mode="eval").body))
+        graph.rebuild()
+        self.assertEquals(graph.find(cid1), graph.find(cid2))
+
+    def test_constants(self):
+        'Operations on constants are folded modulo 2**nbits'
+        graph = egraph.EGraph(8)
+        cid = graph.add(ast.parse("(200 + 100) ^ ~3", mode="eval").body)
+        self.assertEquals(graph.constants[cid], 44 ^ 252)
+
+    def test_extract(self):
+        'Smallest term of a class is extracted'
+        graph = egraph.EGraph(8)
+        cid = graph.add(ast.parse("(x ^ y) + 2*(x & y)", mode="eval").body)
+        graph.union(cid, graph.add(ast.parse("x + y", mode="eval").body))
+        graph.rebuild()
+        self.assertEquals(egraph.unparse(graph.extract(cid)).strip(),
+                          "(x + y)")
+
+    def test_max_nodes(self):
+        'Saturation stops when the e-graph is full'
+        rules = egraph.EGraphSimplifier(8).rules
+        graph = egraph.EGraph(8, max_nodes=100)
+        expr, _ = MBAGenerator(8, depth=2, seed=0).generate()
+        graph.add(all_preprocessings(ast.parse(expr, mode="eval").body, 8))
+        graph.saturate(rules)
+        self.assertFalse(graph.saturated)
+        # rewritings are only added until the limit is reached
+        self.assertLess(graph.size(), 120)
+
+    def test_saturated(self):
+        'Saturation stops when nothing new is found'
+        rules = egraph.EGraphSimplifier(8).rules
+        graph = egraph.EGraph(8)
+        graph.add(ast.parse("x + 1", mode="eval").body)
+        graph.saturate(rules)
+        self.assertTrue(graph.saturated)
+        self.assertLess(graph.iterations, egraph.MAX_ITERATIONS)
+
+
+class TestEGraphSimplifier(unittest.TestCase):
+    """
+    Tests for simplification with equality saturation.
+    """
+
+    def test_basics(self):
+        'Simple MBA expressions'
+        tests = [("(x ^ y) + 2*(x & y)", "(x + y)"),
+                 ("(x | y) - (x & ~y)", "y"),
+                 ("x + x + x", "(3 * x)"),
+                 ("(x & y) + (x | y) + 3", "((x + y) + 3)")]
+        for expr, expected in tests:
+            self.assertEquals(egraph.simplify(expr, 8), expected)
+
+    def test_sum_order(self):
+        'Rules apply on part of a sum, whatever the order of its terms'
+        self.assertEquals(egraph.simplify("(x & y) + 3*z + (x ^ y) + "
+                                          "(x & y)", 8),
+                          "((x + y) + (3 * z))")
+
+    def test_assignments(self):
+        'Values of variables are replaced in next assignments'
+        self.assertEquals(egraph.simplify("a = (x ^ y) + 2*(x & y)\n"
+                                          "b = a - y", 8),
+                          "a = (x + y)\nb = x")
+
+    def test_custom_rules(self):
+        'Custom rules, with or without default rules'
+        rules = [("2*(A ^ 127)", "2*(~A)")]
+        self.assertEquals(egraph.simplify("2*(x ^ 127)", 8, rules),
+                          "(2 * (~ x))")
+        self.assertEquals(egraph.simplify("(x ^ y) + 2*(x & y)", 8, rules,
+                                          use_default=False),
+                          "((2 * (x & y)) + (x ^ y))")
+
+    def test_budget(self):
+        'Saturation stops after max_steps iterations'
+        budget = simplifier.SimplificationBudget(max_steps=1)
+        egraph.simplify("(x ^ y) + 2*(x & y)", 8, budget=budget)
+        self.assertEquals(budget.steps, 1)
+
+    def test_equivalence(self):
+        'Results are equivalent to generated expressions'
+        gen = MBAGenerator(8, depth=1, seed=1)
+        for _ in range(5):
+            expr, _ = gen.generate()
+            result = egraph.simplify(expr, 8, max_iterations=5)
+            self.assertFalse(evaluator.refute(
+                ast.parse(expr, mode="eval").body,
+                ast.parse(result, mode="eval").body, {"x", "y"}, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
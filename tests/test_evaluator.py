@@ -0,0 +1,52 @@
+"""Tests for evaluator module.
+"""
+
+import ast
+import unittest
+
+from sspam.tools import evaluator
+from sspam.tools.flattening import Flattening
+
+
+class TestEvaluator(unittest.TestCase):
+    """
+    Test evaluation of expressions on random inputs.
+    """
+
+    def test_values(self):
+        'Test evaluation modulo 2**nbits'
+        inputs = {"x": [0, 3, 255], "y": [1, 200, 128]}
+        tests = [("x + y", [1, 203, 127]), ("x - y", [255, 59, 127]),
+                 ("~x ^ (y << 1)", [253, 108, 0]), ("-x*y", [0, 168, 128]),
+                 ("x | (y & 7)", [1, 3, 255])]
+        for expr_string, ref in tests:
+            expr_ast = ast.parse(expr_string, mode="eval")
+            evalu = evaluator.Evaluator(8, inputs, 3)
+            self.assertEquals(evalu.visit(expr_ast), ref)
+
+    def test_refute(self):
+        'Non-equivalent expressions are refuted, equivalent ones are not'
+        tests_eq = [("(x ^ y) + 2*(x & y)", "x + y"),
+                    ("(x | y) - (x & y)", "x ^ y"),
+                    ("x + y + z", "z + (y + x)")]
+        for expr1, expr2 in tests_eq:
+            ast1 = Flattening().visit(ast.parse(expr1, mode="eval"))
+            ast2 = ast.parse(expr2, mode="eval")
+            self.assertFalse(evaluator.refute(ast1, ast2, {"x", "y", "z"}, 8))
+        tests_neq = [("(x ^ y) + (x & y)", "x + y"), ("x", "~x"),
+                     ("x*x", "x"), ("x + 256", "x + 1")]
+        for expr1, expr2 in tests_neq:
+            ast1 = ast.parse(expr1, mode="eval")
+            ast2 = ast.parse(expr2, mode="eval")
+            self.assertTrue(evaluator.refute(ast1, ast2, {"x", "y"}, 16))
+
+    def test_unsupported(self):
+        'Expressions with unsupported nodes are never refuted'
+        ast1 = ast.parse("x >> 1", mode="eval")
+        ast2 = ast.parse("f(x)", mode="eval")
+        self.assertFalse(evaluator.refute(ast1, ast2, {"x"}, 8))
+        self.assertFalse(evaluator.refute(ast2, ast2, {"x"}, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests for generator module.
+"""
+
+import ast
+import unittest
+
+from sspam import simplifier
+from sspam.tools import evaluator
+from sspam.tools.generator import MBAGenerator
+
+
+class TestMBAGenerator(unittest.TestCase):
+    """
+    Test generation of obfuscated expressions.
+    """
+
+    def test_ground_truth(self):
+        'Obfuscated expressions are equivalent to their ground truth'
+        for nbits in (8, 32, 64):
+            for depth in (1, 2):
+                gen = MBAGenerator(nbits, 3, 3, depth, seed=nbits,
+                                   affine=0.3)
+                for _ in range(5):
+                    expr, truth = gen.generate()
+                    self.assertFalse(evaluator.refute(
+                        ast.parse(expr, mode="eval"),
+                        ast.parse(truth, mode="eval"), {"x", "y", "z"},
+                        nbits), (expr, truth))
+
+    def test_parameters(self):
+        'Same seed gives same output, size grows with depth'
+        self.assertEquals(MBAGenerator(seed=3).generate(),
+                          MBAGenerator(seed=3).generate())
+        sizes = [len(MBAGenerator(depth=depth, seed=3).generate()[0])
+                 for depth in (1, 2, 3)]
+        self.assertEquals(sizes, sorted(sizes))
+        _, truth = MBAGenerator(nvars=1, terms=4, seed=3).generate()
+        self.assertEquals(truth.count("x"), 4)
+        self.assertFalse("y" in truth)
+
+    def test_no_trivial_terms(self):
+        'Terms of ground truth never use the same variable twice'
+        gen = MBAGenerator(8, 2, 4, seed=5)
+        for _ in range(20):
+            truth = ast.parse(gen.generate()[1], mode="eval")
+            for node in ast.walk(truth):
+                if (isinstance(node, ast.BinOp) and
+                        isinstance(node.left, ast.Name) and
+                        isinstance(node.right, ast.Name)):
+                    self.assertNotEquals(node.left.id, node.right.id)
+                if isinstance(node, ast.Num):
+                    self.assertTrue(0 < node.n < 255)
+
+    def test_simplification(self):
+        'Simplified expression is still equivalent to ground truth'
+        gen = MBAGenerator(8, 2, 2, 1, seed=0)
+        for _ in range(3):
+            expr, truth = gen.generate()
+            result = simplifier.simplify(expr, 8)
+            self.assertFalse(evaluator.refute(
+                ast.parse(result, mode="eval"),
+                ast.parse(truth, mode="eval"), {"x", "y"}, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests for the cost of importing sspam.
+
+Heavy dependencies (sympy, z3, astunparse, pygraphviz) must only be
+imported when they are first needed, so that short invocations of
+sspam (like sspam --help) stay fast.
+"""
+
+import ast
+import os
+import subprocess
+import sys
+import unittest
+
+
+HEAVY_MODULES = ["astunparse", "pygraphviz", "sympy", "z3"]
+
+SCRIPT = """
+import sys
+try:
+    %s
+except SystemExit:
+    pass
+heavy = sorted(mod for mod in %r if mod in sys.modules)
+sys.stderr.write("%%r\\n" %% (heavy,))
+"""
+
+
+class TestImports(unittest.TestCase):
+    """
+    Test that heavy dependencies are imported lazily.
+    """
+
+    def heavy_imports(self, statement):
+        'Run statement in a new interpreter, return heavy modules loaded'
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join([root,
+                                             env.get("PYTHONPATH", "")])
+        proc = subprocess.Popen([sys.executable, "-c",
+                                 SCRIPT % (statement, HEAVY_MODULES)],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        _, err = proc.communicate()
+        # z3 may print some noise when interpreter exits
+        result = [line for line in err.splitlines() if line.startswith("[")]
+        return ast.literal_eval(result[-1])
+
+    def test_lazy(self):
+        'Importing sspam and sspam --help do not load heavy modules'
+        for statement in ["import sspam",
+                          "import sspam.simplifier, sspam.tools.cse",
+                          "import sspam.tools.dag_translator",
+                          "import sspam.egraph, sspam.server",
+                          "from sspam.__main__ import main; main(['-h'])"]:
+            self.assertEquals(self.heavy_imports(statement), [], statement)
+
+    def test_loaded_when_needed(self):
+        'Heavy modules are loaded by simplification'
+        heavy = self.heavy_imports("from sspam import simplifier; "
+                                   "simplifier.simplify('(x ^ 210) + "
+                                   "2*(x | 45)')")
+        self.assertEquals(heavy, ["astunparse", "sympy", "z3"])
+
+
+if __name__ == '__main__':
+    unittest.main()
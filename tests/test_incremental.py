@@ -0,0 +1,45 @@
+"""Tests for incremental module.
+"""
+
+import unittest
+
+from sspam import simplifier
+from sspam.incremental import IncrementalSimplifier
+
+
+PROGRAM = """a = (x ^ y) + 2*(x & y)
+b = (z | 3) - (z & 3)
+c = (a & b) + (a | b)
+d = b + 1
+e = c - d"""
+
+
+class TestIncremental(unittest.TestCase):
+    """
+    Test re-simplification of edited programs.
+    """
+
+    def test_edit(self):
+        'Only statements downstream of an edit are simplified again'
+        simp = IncrementalSimplifier(8)
+        self.assertEquals(simp.simplify(PROGRAM),
+                          simplifier.simplify(PROGRAM, 8))
+        self.assertEquals((simp.simplified, simp.reused), (5, 0))
+        # same program: everything is re-used
+        simp.simplify(PROGRAM)
+        self.assertEquals((simp.simplified, simp.reused), (0, 5))
+        # a is different but simplifies to the same value, so c and e
+        # are not simplified again
+        edited = PROGRAM.replace("(x ^ y) + 2*(x & y)", "(x & y) + (x | y)")
+        self.assertEquals(simp.simplify(edited),
+                          simplifier.simplify(edited, 8))
+        self.assertEquals((simp.simplified, simp.reused), (1, 4))
+        # a, c and e change, b and d don't
+        edited = PROGRAM.replace("2*(x & y)", "2*(x | y)")
+        self.assertEquals(simp.simplify(edited),
+                          simplifier.simplify(edited, 8))
+        self.assertEquals((simp.simplified, simp.reused), (3, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+"""Tests for the command line (__main__ module).
+"""
+
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from sspam import simplifier
+from sspam.__main__ import main, simplify_jsonl
+from sspam.simplifier import SimplificationBudget
+
+
+class TestJsonl(unittest.TestCase):
+    """
+    Test streaming of json records.
+    """
+
+    def test_records(self):
+        'One output record per input record, errors do not stop stream'
+        lines = ['{"id": 1, "expr": "(x ^ y) + 2*(x & y)"}', '',
+                 '{"id": "b", "expr": "(x | y) - (x & y)", "nbits": 8}',
+                 '{"id": 3, "expr": "x +"}', 'not json',
+                 '{"id": 5, "expr": "x + 0"}']
+        records = list(simplify_jsonl(iter(lines)))
+        self.assertEquals([rec["id"] for rec in records],
+                          [1, "b", 3, None, 5])
+        self.assertEquals(records[0]["result"], "(x + y)")
+        self.assertEquals(records[1]["result"], "(x ^ y)")
+        self.assertTrue("error" in records[2])
+        self.assertTrue("error" in records[3])
+        self.assertEquals(records[4]["result"], "x")
+        for rec in records:
+            json.dumps(rec)
+            if "result" in rec:
+                self.assertTrue(rec["time"] >= 0)
+                self.assertTrue(isinstance(rec["stats"], dict))
+
+    def test_partial(self):
+        'Records of results cut by budget are marked as partial'
+        lines = ['{"id": 1, "expr": "(x & y) + (x | y)"}']
+        budget = SimplificationBudget(max_steps=1)
+        record, = simplify_jsonl(iter(lines), 8, budget=budget)
+        self.assertTrue(record["partial"])
+        record, = simplify_jsonl(iter(lines), 8)
+        self.assertFalse("partial" in record)
+        self.assertEquals(record["result"], "(x + y)")
+
+
+class TestMain(unittest.TestCase):
+    """
+    Test options of the command line.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_main(self, args):
+        'Return output lines of main with args'
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            main(args)
+            return sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+
+    def test_rules(self):
+        'Rules of --rules are used in every mode, default ones are kept'
+        default_rules = simplifier.DEFAULT_RULES
+        rules = os.path.join(self.tmpdir, "rules")
+        simplifier.save_rules(rules, [("(A & B) + (A | B)", "A + B")])
+        exprs = os.path.join(self.tmpdir, "exprs")
+        with open(exprs, "w") as output:
+            output.write("(x & y) + (x | y)\n(x ^ y) + 2*(x & y)\n")
+        records = os.path.join(self.tmpdir, "records")
+        with open(records, "w") as output:
+            output.write('{"id": 1, "expr": "(x & y) + (x | y)"}\n'
+                         '{"id": 2, "expr": "(x ^ y) + 2*(x & y)"}\n')
+        expected = ["(x + y)", "((2 * (x & y)) + (x ^ y))"]
+        self.assertEquals(self.run_main(["--rules", rules, "-n", "8",
+                                         "(x ^ y) + 2*(x & y)"]),
+                          expected[1:])
+        self.assertEquals(self.run_main(["--rules", rules, "-n", "8",
+                                         "--batch", "-j", "2", exprs]),
+                          expected)
+        self.assertEquals([json.loads(line)["result"] for line in
+                           self.run_main(["--rules", rules, "-n", "8",
+                                          "--jsonl", records])],
+                          expected)
+        self.assertTrue(simplifier.DEFAULT_RULES is default_rules)
+
+    def test_batch_error(self):
+        'A bad line of a batch gets an empty output line, others go on'
+        exprs = os.path.join(self.tmpdir, "exprs")
+        with open(exprs, "w") as output:
+            output.write("(x ^ y) + 2*(x & y)\nx +\n(x | y) - (x & y)\n")
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            lines = self.run_main(["-n", "8", "--batch", "-j", "2", exprs])
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEquals(lines, ["(x + y)", "", "(x ^ y)"])
+        self.assertTrue("expression 2: SyntaxError" in errors)
+
+    def test_stats(self):
+        'Statistics are reported for a single expression only'
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.run_main(["--stats", "(x ^ y) + 2*(x & y)"])
+            report = sys.stderr.getvalue()
+            for args in (["--batch", "-"], ["--jsonl", "-"],
+                         ["--server", "sock"], ["-j", "2", "x"]):
+                self.assertRaises(SystemExit, main, ["--stats"] + args)
+            # solver counters are part of --stats
+            self.assertRaises(SystemExit, main, ["--z3-stats", "x"])
+        finally:
+            sys.stderr = stderr
+        self.assertTrue("fixpoint iterations" in report)
+
+    def test_rule_profile(self):
+        'Profile is updated in this process, rejected with workers'
+        profile = os.path.join(self.tmpdir, "profile.json")
+        self.assertEquals(self.run_main(["--rule-profile", profile, "-n",
+                                         "8", "(x & y) + (x | y)"]),
+                          ["(x + y)"])
+        self.assertTrue(os.path.exists(profile))
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            for args in (["--batch", "-"], ["--server", "sock"],
+                         ["-j", "2", "x"]):
+                self.assertRaises(SystemExit, main,
+                                  ["--rule-profile", profile] + args)
+        finally:
+            sys.stderr = stderr
+
+
+if __name__ == '__main__':
+    unittest.main()
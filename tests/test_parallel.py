@@ -0,0 +1,88 @@
+"""Tests for parallel module.
+"""
+
+import ast
+import unittest
+
+from sspam import parallel, simplifier
+
+
+class TestSimplifyMany(unittest.TestCase):
+    """
+    Test batch simplification.
+    """
+
+    exprs = ["(x ^ y) + 2*(x & y)", "(x | y) - (x & y)", "x + 0",
+             "(a & b) + (a | b)", "-b + 2*(~a & b)"]
+
+    def test_order(self):
+        'Results are the same as simplify() and in input order'
+        refs = [simplifier.simplify(expr) for expr in self.exprs]
+        for workers in (1, 3):
+            results = list(parallel.simplify_many(self.exprs,
+                                                  workers=workers))
+            self.assertEquals(results, refs)
+
+    def test_error(self):
+        'An expression that can not be simplified does not stop others'
+        exprs = ["(x ^ y) + 2*(x & y)", "x +", "(x | y) - (x & y)"]
+        for workers in (1, 2):
+            results = list(parallel.simplify_many(exprs, nbits=8,
+                                                  workers=workers))
+            self.assertEquals([results[0], results[2]],
+                              ["(x + y)", "(x ^ y)"])
+            self.assertTrue(isinstance(results[1], Exception))
+            self.assertTrue("SyntaxError" in str(results[1]))
+
+    def test_bounded(self):
+        'Input is read as workers need it, not up front'
+        read = []
+
+        def exprs():
+            'Record expressions read'
+            for i in range(100):
+                read.append(i)
+                yield "x + %d" % (i + 1)
+        results = parallel.simplify_many(exprs(), nbits=8, workers=2)
+        self.assertEquals(next(results), "(x + 1)")
+        self.assertTrue(len(read) <= 2*parallel.MAX_PENDING + 1,
+                        len(read))
+        self.assertEquals(len(list(results)), 99)
+        self.assertEquals(len(read), 100)
+
+    def test_rules_compiled_once(self):
+        'Rules are compiled once per number of bits'
+        simplifier.COMPILED_RULES.clear()
+        list(parallel.simplify_many(self.exprs, nbits=8, workers=1))
+        self.assertEquals(len(simplifier.COMPILED_RULES), 1)
+
+
+class TestSimplifyProgram(unittest.TestCase):
+    """
+    Test parallel simplification of assignments.
+    """
+
+    program = """a = (x ^ y) + 2*(x & y)
+b = (z | 3) - (z & 3)
+c = (a & b) + (a | b)
+a = a + 1
+d = (a | b) - (a & b)
+(x | y) - (x & y)"""
+
+    def test_dependencies(self):
+        'Statements depend on last assignments of variables they read'
+        body = ast.parse(self.program).body
+        self.assertEquals(parallel.get_dependencies(body),
+                          [{}, {}, {"a": 0, "b": 1}, {"a": 0},
+                           {"a": 3, "b": 1}, {}])
+        body = ast.parse("a = x\nif a:\n  b = a").body
+        self.assertEquals(parallel.get_dependencies(body), None)
+
+    def test_same_output(self):
+        'Output is the same as sequential mode'
+        self.assertEquals(parallel.simplify_program(self.program, 8, 3),
+                          simplifier.simplify(self.program, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
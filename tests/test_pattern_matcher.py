@@ -4,6 +4,8 @@ This module contains tests for the pattern matcher module.
 
 Tested features are:
   - pure pattern matcher with various situations
+  - bindings of wildcards
+  - cache of z3 equivalence verdicts
   - pattern replacement
 """
 # pylint: disable=relative-import
@@ -153,6 +155,20 @@ class TestPatternMatcher(PatternMatcherTest):
         pat = pattern_matcher.PatternMatcher(test_neg)
         self.assertFalse(pat.visit(test_neg, patt_ast))
 
+    def test_large_flattened(self):
+        'Test matchings of large flattened sums'
+        ops = ["&", "|", "^"]*3
+        terms = ["(x%d %s y%d)" % (i, op, i) for i, op in enumerate(ops)]
+        wilds = ["(%s %s %s)" % (chr(65 + 2*i), op, chr(66 + 2*i))
+                 for i, op in enumerate(ops)]
+        input_string = " + ".join(reversed(terms)) + " + t"
+        patt_string = " + ".join(wilds)
+        self.generic_test_positive(input_string, patt_string + " + Z", True)
+        self.generic_test_negative(input_string, patt_string + " + (Y & Z)",
+                                   True)
+        input_string = " + ".join("x%d" % i for i in range(10))
+        self.generic_test_negative(input_string, patt_string + " + Z", True)
+
     def test_with_nbits(self):
         'Test with nbits given by the user'
         tests = [("(x ^ 52) + 2*(x | 203)", 8),
@@ -171,6 +187,20 @@ class TestPatternMatcher(PatternMatcherTest):
         for input_string in tests:
             self.generic_test_positive(input_string, pattern_string)
 
+    def test_compiled(self):
+        'Compiled patterns give the same results as plain patterns'
+        tests = [("(x ^ ~y) + 2*(x | y)", "(A ^ ~B) + 2*(A | B)", True),
+                 ("(x ^ 210) + 2*(x | 45)", "(A ^ ~B) + 2*(A | B)", True),
+                 ("(x ^ 210) + 2*(x | 44)", "(A ^ ~B) + 2*(A | B)", False),
+                 ("Fun(x, g(y))", "Fun(A, g(B))", True),
+                 ("Fun(x)", "Fun(A, g(B))", False)]
+        for input_string, patt_string, ref in tests:
+            input_ast = ast.parse(input_string)
+            compiled = pattern_matcher.CompiledPattern(ast.parse(patt_string))
+            pat = pattern_matcher.PatternMatcher(input_ast, 0, compiled)
+            self.assertEquals(pat.visit(input_ast.body[0].value,
+                                        compiled.patt_ast), ref)
+
     def test_root(self):
         'Test with different types of roots'
         pattern_ast = ast.parse("A + B", mode='eval')
@@ -179,6 +209,129 @@ class TestPatternMatcher(PatternMatcherTest):
         self.assertTrue(pat.visit(input_ast, pattern_ast))
 
 
+class TestBindings(unittest.TestCase):
+    """
+    Test backtracking on bindings of wildcards.
+    """
+
+    def test_undo_redo(self):
+        'Test that undo and redo restore the expected states'
+        value_x = ast.Name("x", ast.Load())
+        value_y = ast.Name("y", ast.Load())
+        bindings = pattern_matcher.Bindings()
+        bindings["A"] = value_x
+        mark = bindings.mark()
+        bindings["B"] = value_y
+        bindings["A"] = value_y
+        changes = bindings.changes(mark)
+        bindings.undo(mark)
+        self.assertEquals(bindings, {"A": value_x})
+        self.assertTrue(bindings["A"] is value_x)
+        bindings["C"] = value_x
+        bindings.undo(mark)
+        bindings.redo(changes)
+        self.assertEquals(bindings, {"A": value_y, "B": value_y})
+        bindings.undo(0)
+        self.assertEquals(bindings, {})
+
+    def test_key(self):
+        'Equivalent bindings have the same key'
+        bindings_a = pattern_matcher.Bindings()
+        bindings_a["A"] = ast.parse("x + 2*y", mode="eval").body
+        bindings_a["B"] = ast.parse("3", mode="eval").body
+        bindings_b = pattern_matcher.Bindings()
+        bindings_b["B"] = ast.parse("3", mode="eval").body
+        bindings_b["A"] = ast.parse("y*2 + x", mode="eval").body
+        no_solution = {bindings_a.key()}
+        self.assertTrue(bindings_b.key() in no_solution)
+        bindings_b["B"] = ast.parse("4", mode="eval").body
+        self.assertFalse(bindings_b.key() in no_solution)
+
+
+class TestEquivalenceCache(unittest.TestCase):
+    """
+    Test cache of z3 verdicts used by the pattern matcher.
+    """
+
+    def setUp(self):
+        pattern_matcher.EQ_CACHE.clear()
+
+    def test_lru(self):
+        'Test eviction of least recently used entries'
+        cache = pattern_matcher.EquivalenceCache(2)
+        cache.set("a", True)
+        cache.set("b", False)
+        self.assertTrue(cache.get("a"))
+        cache.set("c", True)
+        self.assertEquals(cache.get("b"), None)
+        self.assertFalse(cache.get("c") is None)
+        self.assertEquals(cache.stats(), {"size": 2, "hits": 2,
+                                          "misses": 1, "evictions": 1})
+        cache = pattern_matcher.EquivalenceCache(0)
+        cache.set("a", True)
+        self.assertEquals(cache.get("a"), None)
+
+    def test_hits(self):
+        'Test that identical queries are only sent once to z3'
+        for input_string in ["(x ^ ~y) + 2*(x | y)", "2*(y | x) + (~y ^ x)"]:
+            input_ast = ast.parse(input_string)
+            pattern_ast = ast.parse("(A ^ ~B) + 2*(A | B)")
+            pat = pattern_matcher.PatternMatcher(input_ast)
+            self.assertTrue(pat.visit(input_ast, pattern_ast))
+        stats = pattern_matcher.EQ_CACHE.stats()
+        self.assertTrue(stats["misses"] > 0)
+        self.assertTrue(stats["hits"] > 0)
+
+    def test_refutation(self):
+        'Test that wrong candidates do not reach z3'
+        pattern_matcher.STATS.clear()
+        input_ast = ast.parse("(x ^ 210) + 2*(x | 44)")
+        pattern_ast = ast.parse("(A ^ ~B) + 2*(A | B)")
+        pat = pattern_matcher.PatternMatcher(input_ast)
+        self.assertFalse(pat.visit(input_ast, pattern_ast))
+        self.assertTrue(pattern_matcher.STATS["refuted"] > 0)
+
+
+class TestSolver(unittest.TestCase):
+    """
+    Test reuse of solvers between queries.
+    """
+
+    def tearDown(self):
+        pattern_matcher.INCREMENTAL = True
+        pattern_matcher.BUDGET = pattern_matcher.SolverBudget()
+
+    def test_incremental(self):
+        'Queries do not leave assertions in shared solver'
+        for incremental in (True, False):
+            pattern_matcher.INCREMENTAL = incremental
+            pattern_matcher.EQ_CACHE.clear()
+            input_ast = ast.parse("(x ^ 210) + 2*(x | 45)")
+            pattern_ast = ast.parse("(A ^ ~B) + 2*(A | B)")
+            pat = pattern_matcher.PatternMatcher(input_ast)
+            self.assertTrue(pat.visit(input_ast, pattern_ast))
+            input_ast = ast.parse("(x ^ 210) + 2*(x | 44)")
+            pat = pattern_matcher.PatternMatcher(input_ast)
+            self.assertFalse(pat.visit(input_ast, pattern_ast))
+        solver = pattern_matcher.SOLVERS[8]
+        self.assertEquals(len(solver.assertions()), 0)
+
+    def test_budget(self):
+        'Queries out of budget do not match and are not cached'
+        pattern_matcher.EQ_CACHE.clear()
+        pattern_matcher.BUDGET = pattern_matcher.SolverBudget(max_queries=1)
+        pattern_matcher.BUDGET.queries = 1
+        target = ast.parse("(x ^ y) + 2*(x & y)", mode="eval").body
+        pattern = ast.parse("x + y", mode="eval").body
+        skipped = pattern_matcher.STATS["z3_skipped"]
+        pat = pattern_matcher.PatternMatcher(target)
+        self.assertFalse(pat.check_eq_z3(target, pattern))
+        self.assertEquals(pattern_matcher.STATS["z3_skipped"], skipped + 1)
+        pattern_matcher.BUDGET.reset()
+        self.assertTrue(pat.check_eq_z3(target, pattern))
+        self.assertEquals(pattern_matcher.BUDGET.queries, 1)
+
+
 class TestPatternReplacement(unittest.TestCase):
     """
     Test PatternReplacement class.
@@ -274,6 +427,58 @@ class TestPatternReplacement(unittest.TestCase):
         input_ast = rep.visit(input_ast)
         self.assertTrue(asttools.Comparator().visit(input_ast, ref_ast))
 
+    def test_failures(self):
+        'Subterms where pattern was not found are skipped in next visits'
+        patt_ast = ast.parse("(A ^ B) + 2*(A & B)", mode='eval')
+        rep_ast = ast.parse("A + B", mode='eval')
+        failures, table = set(), {}
+        input_ast = ast.parse("((x | y) - (x & y)) * ((x ^ y) + 2*(x & y))",
+                              mode='eval')
+        keys = asttools.get_subterm_keys(input_ast, table)
+        rep = pattern_matcher.PatternReplacement(patt_ast, input_ast,
+                                                 rep_ast, 8, failures, keys)
+        output_ast = rep.visit(input_ast)
+        self.assertEquals(rep.replaced, 1)
+        self.assertEquals(rep.skipped, 0)
+        # root and right operand were replaced, they are not failures
+        left_ast = ast.parse("(x | y) - (x & y)", mode='eval')
+        left_keys = asttools.get_subterm_keys(left_ast, table)
+        self.assertEquals(failures, set(
+            left_keys[id(node)] for node in ast.walk(left_ast)
+            if isinstance(node, ast.BinOp)))
+        keys = asttools.get_subterm_keys(output_ast, table)
+        rep = pattern_matcher.PatternReplacement(patt_ast, output_ast,
+                                                 rep_ast, 8, failures, keys)
+        rep.visit(output_ast)
+        self.assertEquals(rep.replaced, 0)
+        self.assertEquals(rep.skipped, 1)
+        self.assertTrue(keys[id(output_ast.body)] in failures)
+
+    def test_failures_budget(self):
+        'Subterms are not failures if the solver ran out of budget'
+        patt_ast = ast.parse("A + B + 1 + (~A | ~B)", mode='eval')
+        rep_ast = ast.parse("A | B", mode='eval')
+        input_ast = ast.parse("x + 2 + (~x | 253)", mode='eval')
+        input_ast = Flattening(ast.Add).visit(input_ast)
+        keys = asttools.get_subterm_keys(input_ast, {})
+        pattern_matcher.EQ_CACHE.clear()
+        pattern_matcher.BUDGET = pattern_matcher.SolverBudget(max_queries=1)
+        pattern_matcher.BUDGET.queries = 1
+        failures = set()
+        try:
+            rep = pattern_matcher.PatternReplacement(
+                patt_ast, input_ast, rep_ast, 8, failures, keys)
+            rep.visit(input_ast)
+        finally:
+            pattern_matcher.BUDGET = pattern_matcher.SolverBudget()
+        self.assertEquals(rep.replaced, 0)
+        self.assertFalse(keys[id(input_ast.body)] in failures)
+        rep = pattern_matcher.PatternReplacement(patt_ast, input_ast,
+                                                 rep_ast, 8, failures, keys)
+        rep.visit(input_ast)
+        self.assertEquals(rep.replaced, 0)
+        self.assertTrue(keys[id(input_ast.body)] in failures)
+
 
 if __name__ == '__main__':
     unittest.main()
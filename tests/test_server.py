@@ -0,0 +1,125 @@
+"""Tests for server module.
+"""
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from sspam import server
+from sspam.tools.generator import MBAGenerator
+
+
+class TestServer(unittest.TestCase):
+    """
+    Test simplification requests sent to the server.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, "sspam.sock")
+        self.server = server.SimplificationServer(path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.client.connect(path)
+        self.stream = self.client.makefile("r+")
+
+    def tearDown(self):
+        self.stream.close()
+        self.client.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def send(self, request):
+        'Send one request to server'
+        self.stream.write(json.dumps(request) + "\n")
+        self.stream.flush()
+
+    def receive(self):
+        'Read one response of server'
+        return json.loads(self.stream.readline())
+
+    def test_requests(self):
+        'Results, errors, timeouts and cancellations'
+        self.send({"id": 1, "expr": "(x ^ y) + 2*(x & y)"})
+        self.assertEquals(self.receive()["result"], "(x + y)")
+        self.send({"id": 2, "expr": "x +"})
+        self.assertTrue("error" in self.receive())
+        self.send({"id": 3, "expr": "(x | y) - (x & y)", "timeout": 1e-6})
+        self.assertEquals(self.receive(), {"id": 3, "timeout": True})
+        # cancellation of a finished request is ignored
+        self.send({"cancel": 3})
+        self.send({"id": 5, "expr": "(x | y) - (x & y)", "nbits": 8})
+        self.assertEquals(self.receive()["result"], "(x ^ y)")
+
+    def test_invalid(self):
+        'Invalid ids and timeouts get an error, connection goes on'
+        for request in ({"id": [1], "expr": "x"},
+                        {"id": {"a": 1}, "expr": "x"},
+                        {"cancel": [1]},
+                        {"id": 1, "expr": "x", "timeout": "1"},
+                        {"id": 2, "expr": "x", "timeout": -1}):
+            self.send(request)
+            response = self.receive()
+            self.assertEquals(response["id"], request.get("id"))
+            self.assertTrue("error" in response)
+        self.send({"id": 3, "expr": "(x | y) - (x & y)", "timeout": 60})
+        self.assertEquals(self.receive()["result"], "(x ^ y)")
+
+    def test_cancel(self):
+        'Cancelled request stops its worker, which is replaced'
+        cancelled = threading.Event()
+        cancelled.set()
+        worker = self.server.workers[0]
+        process = worker.process
+        response = worker.run({"expr": "(x | y) - (x & y)"}, cancelled)
+        self.assertEquals(response, {"cancelled": True})
+        self.assertFalse(worker.process is process)
+        self.send({"id": 1, "expr": "(x | y) - (x & y)"})
+        self.assertEquals(self.receive()["result"], "(x ^ y)")
+
+    def test_cancel_request(self):
+        'Cancellation sent by the client stops a slow request'
+        expr, _ = MBAGenerator(8, depth=5, seed=42).generate()
+        self.send({"id": 1, "expr": expr})
+        self.send({"cancel": 1})
+        self.assertEquals(self.receive(), {"id": 1, "cancelled": True})
+        self.send({"id": 2, "expr": "(x | y) - (x & y)"})
+        self.assertEquals(self.receive()["result"], "(x ^ y)")
+
+    def test_rules(self):
+        'Workers use rules given to the server'
+        worker = server.Worker([("(A & B) + (A | B)", "A + B")], False)
+        try:
+            response = worker.run({"expr": "(x ^ y) + 2*(x & y)",
+                                   "nbits": 8}, threading.Event())
+            self.assertEquals(response["result"],
+                              "((2 * (x & y)) + (x ^ y))")
+            response = worker.run({"expr": "(x & y) + (x | y)",
+                                   "nbits": 8}, threading.Event())
+            self.assertEquals(response["result"], "(x + y)")
+        finally:
+            worker.stop()
+
+    def test_dead_worker(self):
+        'Request of a dead worker gets an error, worker is replaced'
+        process = self.server.workers[0].process
+        process.terminate()
+        process.join()
+        self.send({"id": 1, "expr": "(x | y) - (x & y)"})
+        response = self.receive()
+        self.assertEquals(response["id"], 1)
+        self.assertTrue("error" in response)
+        self.assertFalse(self.server.workers[0].process is process)
+        self.send({"id": 2, "expr": "(x | y) - (x & y)"})
+        self.assertEquals(self.receive()["result"], "(x ^ y)")
+
+
+if __name__ == '__main__':
+    unittest.main()
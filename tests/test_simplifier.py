@@ -2,9 +2,15 @@
 """
 # pylint: disable=relative-import
 
+import ast
 import os
+import shutil
+import tempfile
 import unittest
 
+from sspam import simplifier
+from sspam.tools import evaluator
+from sspam.tools.flattening import Flattening
 from templates import SimplifierTest
 
 
@@ -49,6 +55,206 @@ class TestSimplifier(SimplifierTest):
         for input_args, refstring in tests:
             self.generic_test(input_args, refstring)
 
+    def test_nbits_matching(self):
+        'Patterns are matched with the number of bits of expression'
+        expr = "(-x) + y + (x | y)"
+        result = simplifier.simplify(expr, 8)
+        self.assertNotEquals(result, "((- x) & y)")
+        self.assertFalse(evaluator.refute(ast.parse(result, mode="eval"),
+                                          ast.parse(expr, mode="eval"),
+                                          {"x", "y"}, 8))
+
+
+class TestRuleIndex(unittest.TestCase):
+    """
+    Tests for selection of candidate rules.
+    """
+
+    def test_candidates(self):
+        'Only rules with a matching head are candidates'
+        rules = [("(A & B) + (A | B)", "A + B"),
+                 ("A + B + 1 + (~A | ~B)", "(A | B)"),
+                 ("(A | B) - (A & B)", "A ^ B"),
+                 ("2*(A ^ B)", "A"),
+                 ("(0 | A)", "A")]
+        simp = simplifier.Simplifier(8, rules)
+        tests = [("x | y", [3, 4]),
+                 ("x + (y | z)", [0, 2, 3, 4]),
+                 ("x + y + 1 + z", [0, 1, 2, 3]),
+                 ("f(x)", [3])]
+        for expr_string, ref in tests:
+            expr_ast = ast.parse(expr_string, mode="eval").body
+            expr_ast = Flattening(ast.Add).visit(expr_ast)
+            self.assertEquals(simp.index.candidates(expr_ast), ref)
+
+
+class TestSavedRules(unittest.TestCase):
+    """
+    Tests for rules saved in a file.
+    """
+
+    def test_save_load(self):
+        'Loaded rules are not compiled again and give same results'
+        rules = [("(A & B) + (A | B)", "A + B"),
+                 ("(A | B) - (A & B)", "A ^ B")]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "rules.pickle")
+            simplifier.save_rules(path, rules, [8])
+            simplifier.COMPILED_RULES.clear()
+            loaded = simplifier.load_rules(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEquals(loaded, rules)
+        self.assertEquals(simplifier.COMPILED_RULES.keys(),
+                          [(tuple(rules), 8)])
+        compiled = simplifier.COMPILED_RULES[(tuple(rules), 8)]
+        self.assertEquals(simplifier.simplify("(x & y) + (x | y)", 8,
+                                              loaded, False), "(x + y)")
+        self.assertTrue(simplifier.compile_rules(rules, 8) is compiled)
+
+
+class TestSimplificationStats(unittest.TestCase):
+    """
+    Tests for statistics of simplification.
+    """
+
+    def test_stats(self):
+        'Stages, iterations and rules are reported'
+        rules = [("(A & B) + (A | B)", "A + B"),
+                 ("(A | B) - (A & B)", "A ^ B"),
+                 ("A + B - (A | B)", "A & B")]
+        result, stats = simplifier.simplify_stats(
+            "a = (x & y) + (x | y)\nb = 3 + a", 8, rules, False)
+        self.assertEquals(result, "a = (x + y)\nb = ((x + y) + 3)")
+        self.assertTrue(stats.iterations >= 2)
+        for stage in ["parse", "arithm_simpl", "pre_processing",
+                      "matching", "copy", "folding", "fixpoint", "unparse"]:
+            self.assertTrue(stage in stats.times, stage)
+        self.assertEquals(stats.rules["(A & B) + (A | B)"]["matches"], 1)
+        self.assertEquals(stats.rules["A + B - (A | B)"]["matches"], 0)
+        self.assertTrue("fixpoint iterations" in stats.report())
+        self.assertEquals(stats.as_dict()["iterations"], stats.iterations)
+
+    def test_memoize(self):
+        'Rules that did not match are not tried again on same subterms'
+        expr = "((x & y) + (x | y)) * ((x | y) - (x & y))"
+        _, stats = simplifier.simplify_stats(expr, 8)
+        self.assertTrue(sum(counters["skipped"]
+                            for counters in stats.rules.values()) > 0)
+        simplifier.MEMOIZE = False
+        try:
+            expected, stats = simplifier.simplify_stats(expr, 8)
+        finally:
+            simplifier.MEMOIZE = True
+        self.assertEquals(sum(counters["skipped"]
+                              for counters in stats.rules.values()), 0)
+        self.assertEquals(simplifier.simplify(expr, 8), expected)
+
+
+class TestRuleScheduler(unittest.TestCase):
+    """
+    Tests for adaptive order of rules.
+    """
+
+    rules = [("A + B - (A | B)", "A & B"),
+             ("(A | B) - (A & B)", "A ^ B"),
+             ("(A & B) + (A | B)", "A + B")]
+
+    def test_order(self):
+        'Rules with many matches come first, never tried rules before'
+        scheduler = simplifier.RuleScheduler()
+        self.assertEquals(scheduler.order([0, 1, 2], self.rules), [0, 1, 2])
+        for _ in range(2):
+            _, stats = simplifier.simplify_stats("(x & y) + (x | y)", 8,
+                                                 self.rules, False)
+            scheduler.update(stats)
+        self.assertEquals(scheduler.rules["(A & B) + (A | B)"]["matches"],
+                          2)
+        # first rule is never tried: it has more operands than target
+        self.assertFalse("A + B - (A | B)" in scheduler.rules)
+        self.assertEquals(scheduler.order([0, 1, 2], self.rules), [0, 2, 1])
+
+    def test_batch(self):
+        'Scheduler learns through simplifications, results are the same'
+        scheduler = simplifier.RuleScheduler()
+        exprs = ["(x & y) + (x | y)", "(x | y) - (x & y)",
+                 "((x & y) + (x | y)) + 3"]
+        for _ in range(2):
+            failed = 0
+            for expr in exprs:
+                result, stats = simplifier.simplify_stats(
+                    expr, 8, self.rules, False, scheduler=scheduler)
+                self.assertEquals(result, simplifier.simplify(
+                    expr, 8, self.rules, False))
+                failed += sum(counters["attempts"] - counters["matches"]
+                              for counters in stats.rules.values())
+            if not _:
+                first = failed
+        self.assertTrue(failed < first)
+
+    def test_profile(self):
+        'Counters are saved and loaded'
+        scheduler = simplifier.RuleScheduler()
+        _, stats = simplifier.simplify_stats("(x & y) + (x | y)", 8,
+                                             self.rules, False)
+        scheduler.update(stats)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "profile.json")
+            scheduler.save(path)
+            loaded = simplifier.RuleScheduler()
+            loaded.load(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEquals(loaded.rules, scheduler.rules)
+
+
+class TestSimplificationBudget(unittest.TestCase):
+    """
+    Tests for budget of simplification.
+    """
+
+    expr = ("(((x ^ y) + 2*(x & y)) | ((x ^ y) + 2*(x & y))) + "
+            "((x & y) + (x | y))")
+
+    def test_steps(self):
+        'Out of steps, smallest expression seen is returned as partial'
+        expected, stats = simplifier.simplify_stats(self.expr, 8)
+        self.assertFalse(stats.partial)
+        sizes = []
+        for steps in range(1, stats.iterations):
+            budget = simplifier.SimplificationBudget(max_steps=steps)
+            result, stats = simplifier.simplify_stats(self.expr, 8,
+                                                      budget=budget)
+            self.assertTrue(stats.partial)
+            self.assertEquals(stats.iterations, steps)
+            self.assertTrue(stats.as_dict()["partial"])
+            self.assertFalse(evaluator.refute(
+                ast.parse(result, mode="eval"),
+                ast.parse(self.expr, mode="eval"), {"x", "y"}, 8))
+            sizes.append(len(result))
+        self.assertTrue(sizes[0] < len(self.expr))
+        self.assertEquals(sizes, sorted(sizes, reverse=True))
+        budget = simplifier.SimplificationBudget(max_steps=100)
+        self.assertEquals(simplifier.simplify(self.expr, 8, budget=budget),
+                          expected)
+
+    def test_timeout(self):
+        'Out of time, next statements are not simplified'
+        budget = simplifier.SimplificationBudget(timeout=1e-6)
+        result, stats = simplifier.simplify_stats(
+            "a = (x & y) + (x | y)\nb = a + 1", 8, budget=budget)
+        self.assertTrue(stats.partial)
+        self.assertEquals(result, "a = ((x & y) + (x | y))\n"
+                          "b = (((x & y) + (x | y)) + 1)")
+        # budget is reset for each simplification
+        budget.timeout = 60
+        result, stats = simplifier.simplify_stats("(x & y) + (x | y)", 8,
+                                                  budget=budget)
+        self.assertFalse(stats.partial)
+        self.assertEquals(result, "(x + y)")
+
 
 if __name__ == '__main__':
     unittest.main()
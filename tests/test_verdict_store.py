@@ -0,0 +1,67 @@
+"""Tests for verdict_store module.
+"""
+
+import ast
+import os
+import shutil
+import tempfile
+import unittest
+
+from sspam import pattern_matcher
+from sspam.verdict_store import VerdictStore
+
+
+class TestVerdictStore(unittest.TestCase):
+    """
+    Test persistence and eviction of verdicts.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "verdicts.db")
+
+    def tearDown(self):
+        pattern_matcher.VERDICT_STORE = None
+        pattern_matcher.EQ_CACHE.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_persistence(self):
+        'Verdicts are found by another store on the same file'
+        store = VerdictStore(self.path)
+        store.set(("eq", "x", "y", 8), False)
+        store.set(("model", 3, "Mult(2,A)", 8), {"A": 129})
+        store.close()
+        store = VerdictStore(self.path)
+        self.assertEquals(store.get(("eq", "x", "y", 8)), False)
+        self.assertEquals(store.get(("model", 3, "Mult(2,A)", 8)),
+                          {"A": 129})
+        self.assertEquals(store.get(("eq", "x", "y", 16)), None)
+        self.assertEquals(store.stats()["hits"], 2)
+
+    def test_eviction(self):
+        'Oldest verdicts are evicted when store is full'
+        store = VerdictStore(self.path, 10)
+        for i in range(11):
+            store.set(("eq", "x", str(i), 8), True)
+        self.assertEquals(store.get(("eq", "x", "0", 8)), None)
+        self.assertEquals(store.get(("eq", "x", "10", 8)), True)
+        self.assertTrue(store.stats()["size"] <= 10)
+
+    def test_matcher(self):
+        'Pattern matcher uses verdicts stored by a previous run'
+        pattern_matcher.VERDICT_STORE = VerdictStore(self.path)
+        input_ast = ast.parse("(x ^ 210) + 2*(x | 45)")
+        pattern_ast = ast.parse("(A ^ ~B) + 2*(A | B)")
+        pat = pattern_matcher.PatternMatcher(input_ast)
+        self.assertTrue(pat.visit(input_ast, pattern_ast))
+        self.assertTrue(pattern_matcher.VERDICT_STORE.stats()["size"] > 0)
+        pattern_matcher.EQ_CACHE.clear()
+        pattern_matcher.VERDICT_STORE = VerdictStore(self.path)
+        pat = pattern_matcher.PatternMatcher(input_ast)
+        self.assertTrue(pat.visit(input_ast, pattern_ast))
+        self.assertTrue(pattern_matcher.VERDICT_STORE.stats()["hits"] > 0)
+        self.assertEquals(pattern_matcher.VERDICT_STORE.stats()["misses"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
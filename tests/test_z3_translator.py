@@ -0,0 +1,60 @@
+"""Tests for z3_translator module.
+"""
+
+import ast
+import unittest
+import z3
+
+from sspam.tools import z3_translator
+from sspam.tools.flattening import Flattening
+
+
+class TestZ3Translator(unittest.TestCase):
+    """
+    Test translation of ast into z3 terms.
+    """
+
+    def check_eq(self, term1, term2):
+        'Check that both terms are equivalent with z3'
+        sol = z3.Solver()
+        sol.add(term1 != term2)
+        self.assertEquals(sol.check(), z3.unsat)
+
+    def test_basics(self):
+        'Translated expressions have the expected semantics'
+        x = z3.BitVec('x', 8)
+        y = z3.BitVec('y', 8)
+        tests = [("(x ^ ~y) + 2*(x | y)", (x ^ ~y) + 2*(x | y)),
+                 ("x - (y << 3) & 45", (x - (y << 3)) & 45),
+                 ("-x >> 1", (-x) >> 1)]
+        for expr_string, ref in tests:
+            expr_ast = ast.parse(expr_string, mode="eval")
+            translator = z3_translator.Z3Translator(8)
+            self.check_eq(translator.visit(expr_ast), ref)
+
+    def test_constants(self):
+        'Constant expressions are Python integers'
+        expr_ast = ast.parse("3*(4 + 5)", mode="eval")
+        self.assertEquals(z3_translator.Z3Translator(8).visit(expr_ast), 27)
+
+    def test_flattened(self):
+        'Flattened operators are translated'
+        x = z3.BitVec('x', 16)
+        y = z3.BitVec('y', 16)
+        expr_ast = ast.parse("x + 2*y + (x & y) + 7", mode="eval")
+        expr_ast = Flattening().visit(expr_ast)
+        translator = z3_translator.Z3Translator(16)
+        self.check_eq(translator.visit(expr_ast), x + 2*y + (x & y) + 7)
+
+    def test_memo(self):
+        'Nodes are translated only once'
+        expr_ast = ast.parse("(x + y)*(x + y)", mode="eval")
+        translator = z3_translator.Z3Translator(8)
+        term = translator.visit(expr_ast.body.left)
+        self.assertTrue(translator.visit(expr_ast.body.left) is term)
+        self.assertTrue(z3_translator.get_symbol('x', 8) is
+                        z3_translator.get_symbol('x', 8))
+
+
+if __name__ == '__main__':
+    unittest.main()